@@ -0,0 +1,426 @@
+"""
+Offline stand-ins for the services used by the MFA tasks.
+
+`Directory` keeps an Active Directory like tree in ldap3's `MOCK_SYNC`
+strategy and hands out connections that answer like `SAFE_SYNC` ones,
+`FakeDuo` serves the parts of the DUO Admin API used by the tasks with
+configurable latency and rate limit and `RosterServer` publishes an
+enrollment roster over local HTTP.
+"""
+import json
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+
+from ldap3 import (
+    BASE,
+    MOCK_SYNC,
+    MODIFY_ADD,
+    MODIFY_DELETE,
+    MODIFY_REPLACE,
+    OFFLINE_AD_2012_R2,
+    SUBTREE,
+    Connection,
+    Server,
+)
+
+from outpost.django.mfa.directory import ConnectionPool
+from outpost.django.mfa.duo import (
+    Admin,
+    SharedTokenBucket,
+)
+
+
+class Directory:
+    """
+    In-memory directory with people, the MFA group and the locked group.
+
+    Group membership is kept in `member` of the group entries and mirrored
+    to `memberOf` of the persons like Active Directory does. Adding present
+    or removing absent members succeeds as with the permissive modify
+    control. The root DSE carries no `highestCommittedUSN`, so synchronization
+    always scans the whole tree.
+
+    The mock strategy evaluates filters against every entry, searches for
+    persons by a list of `cn` values are answered from an index instead so
+    that the cost of the mock does not dominate lookups in large trees.
+    """
+
+    lookup = re.compile(r"^\(&\(objectClass=person\)\(\|((?:\(cn=[^()*]+\))+)\)\)$")
+
+    host = "ldap.bench.test"
+    base = "dc=bench,dc=test"
+
+    def __init__(self):
+        self.people = f"ou=people,{self.base}"
+        self.users_group = f"cn=mfa-users,ou=groups,{self.base}"
+        self.locked_group = f"cn=mfa-locked,ou=groups,{self.base}"
+        self.bind_dn = f"cn=bench,ou=services,{self.base}"
+        self.password = "bench"
+        self.server = Server(self.host, get_info=OFFLINE_AD_2012_R2)
+        self.connection = Connection(
+            self.server,
+            self.bind_dn,
+            self.password,
+            client_strategy=MOCK_SYNC,
+        )
+        self.connection.strategy.add_entry(
+            self.bind_dn,
+            {"objectClass": ["top", "user"], "userPassword": self.password},
+        )
+        self.members = {self.users_group: dict(), self.locked_group: dict()}
+        self.names = dict()
+        self.lock = threading.RLock()
+        self.operations = Counter()
+
+    def dn(self, username):
+        return f"cn={username},{self.people}"
+
+    def populate(self, users):
+        """
+        Add persons from `(username, groups)` pairs and create the groups.
+        """
+        for username, groups in users:
+            dn = self.dn(username)
+            self.names[username.lower()] = dn
+            self.connection.strategy.add_entry(
+                dn,
+                {
+                    "objectClass": ["top", "person", "user"],
+                    "cn": username,
+                    "sAMAccountName": username,
+                    "givenName": username.title(),
+                    "sn": "Benchmark",
+                    "mail": f"{username}@bench.test",
+                    "memberOf": list(groups),
+                },
+            )
+            for group in groups:
+                self.members[group][dn.lower()] = dn
+        for group, members in self.members.items():
+            self.connection.strategy.add_entry(
+                group,
+                {"objectClass": ["top", "group"], "member": list(members.values())},
+            )
+        self.connection.bind()
+
+    def search(self, base, query, scope, attributes, **kwargs):
+        self.operations["search"] += 1
+        if base == "" and scope == BASE:
+            entry = {
+                "type": "searchResEntry",
+                "dn": "",
+                "attributes": {"dnsHostName": self.host},
+            }
+            return True, {"result": 0, "description": "success"}, [entry], None
+        match = self.lookup.match(query)
+        with self.lock:
+            if not match:
+                status = self.connection.search(
+                    base, query, scope, attributes=attributes, **kwargs
+                )
+                return status, self.connection.result, self.connection.response, None
+            response = list()
+            for name in re.findall(r"\(cn=([^()]+)\)", match.group(1)):
+                dn = self.names.get(name.lower())
+                if dn and dn.lower().endswith(base.lower()):
+                    self.connection.search(
+                        dn, "(objectClass=person)", BASE, attributes=attributes
+                    )
+                    response.extend(self.connection.response)
+            return bool(response), self.connection.result, response, None
+
+    def modify(self, dn, changes, controls=None):
+        self.operations["modify"] += 1
+        with self.lock:
+            if dn not in self.members or set(changes) != {"member"}:
+                status = self.connection.modify(dn, changes)
+                return status, self.connection.result, None, None
+            members = self.members[dn]
+            for operation, values in changes["member"]:
+                for value in values:
+                    key = value.lower()
+                    if operation == MODIFY_ADD and key not in members:
+                        members[key] = value
+                        self.connection.modify(
+                            value, {"memberOf": [(MODIFY_ADD, [dn])]}
+                        )
+                    elif operation == MODIFY_DELETE and key in members:
+                        del members[key]
+                        self.connection.modify(
+                            value, {"memberOf": [(MODIFY_DELETE, [dn])]}
+                        )
+            status = self.connection.modify(
+                dn, {"member": [(MODIFY_REPLACE, list(members.values()))]}
+            )
+            return status, self.connection.result, None, None
+
+    def connect(self):
+        return SafeConnection(self)
+
+
+class SafeConnection:
+    """
+    Connection to a `Directory` with the result tuples of `SAFE_SYNC`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.closed = False
+        self.bound = True
+
+    def open(self):
+        self.closed = False
+
+    def bind(self):
+        self.bound = True
+        return True, {"result": 0, "description": "success"}, None, None
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+    def search(self, base, query, scope=SUBTREE, attributes=None, **kwargs):
+        return self.directory.search(base, query, scope, attributes, **kwargs)
+
+    def modify(self, dn, changes, controls=None):
+        return self.directory.modify(dn, changes, controls)
+
+
+class DirectoryPool(ConnectionPool):
+    """
+    `ConnectionPool` handing out connections to a `Directory`.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def get_server(self):
+        self.server = self.directory.server
+        return self.server
+
+    def _open(self):
+        self.get_server()
+        now = time.monotonic()
+        return [self.directory.connect(), now, now]
+
+
+class FakeResponse:
+    def __init__(self, status, reason, payload):
+        self.status = status
+        self.reason = reason
+        self.data = json.dumps(payload).encode("utf-8")
+
+    def read(self):
+        return self.data
+
+    def getheaders(self):
+        return [("Content-Type", "application/json")]
+
+
+class FakeDuo:
+    """
+    DUO Admin API users, directory sync and phone endpoints held in memory.
+
+    Every response is delayed by `latency` seconds, more than `rate` requests
+    within one second are answered with HTTP 429.
+    """
+
+    def __init__(self, latency=0.0, rate=None):
+        self.latency = latency
+        self.rate = rate
+        self.users = dict()
+        self.user_ids = dict()
+        self.requests = Counter()
+        self.window = (0, 0)
+        self.lock = threading.Lock()
+
+    def add_user(self, username, is_enrolled, created, phones=()):
+        user_id = uuid.uuid4().hex[:20].upper()
+        self.users[user_id] = {
+            "user_id": user_id,
+            "username": username,
+            "is_enrolled": is_enrolled,
+            "created": created,
+            "status": "active",
+            "phones": [
+                {
+                    "phone_id": uuid.uuid4().hex[:20].upper(),
+                    "number": number,
+                    "activated": activated,
+                }
+                for number, activated in phones
+            ],
+        }
+        self.user_ids[username] = user_id
+        return self.users[user_id]
+
+    def throttled(self):
+        if not self.rate:
+            return False
+        with self.lock:
+            second = int(time.time())
+            start, count = self.window
+            if start != second:
+                start, count = second, 0
+            count += 1
+            self.window = (start, count)
+        return count > self.rate
+
+    def handle(self, method, uri, body):
+        self.requests[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttled():
+            self.requests["throttled"] += 1
+            return FakeResponse(
+                429,
+                "Too Many Requests",
+                {"stat": "FAIL", "code": 42901, "message": "Too Many Requests"},
+            )
+        url = urllib.parse.urlsplit(uri)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if body:
+            if isinstance(body, bytes):
+                body = body.decode("utf-8")
+            try:
+                params.update(json.loads(body))
+            except ValueError:
+                params.update(urllib.parse.parse_qsl(body))
+        path = url.path.rstrip("/").split("/")[3:]
+        with self.lock:
+            if method == "GET" and path == ["users"]:
+                return self.list_users(params)
+            if method == "POST" and path[:2] == ["users", "directorysync"]:
+                return self.sync_user(params["username"])
+            if method == "DELETE" and len(path) == 4 and path[2] == "phones":
+                return self.delete_phone(path[1], path[3])
+        return FakeResponse(
+            404, "Not Found", {"stat": "FAIL", "code": 40400, "message": "Not Found"}
+        )
+
+    def list_users(self, params):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        users = list(self.users.values())[offset : offset + limit]
+        metadata = {"total_objects": len(self.users)}
+        if offset + limit < len(self.users):
+            metadata["next_offset"] = offset + limit
+        return FakeResponse(
+            200, "OK", {"stat": "OK", "response": users, "metadata": metadata}
+        )
+
+    def sync_user(self, username):
+        user_id = self.user_ids.get(username)
+        user = self.users[user_id] if user_id else None
+        if not user:
+            user = self.add_user(username, False, int(time.time()))
+        return FakeResponse(200, "OK", {"stat": "OK", "response": user})
+
+    def delete_phone(self, user_id, phone_id):
+        user = self.users.get(user_id)
+        if not user:
+            return FakeResponse(
+                404,
+                "Not Found",
+                {"stat": "FAIL", "code": 40401, "message": "Not Found"},
+            )
+        user["phones"] = [p for p in user["phones"] if p["phone_id"] != phone_id]
+        return FakeResponse(200, "OK", {"stat": "OK", "response": ""})
+
+
+class FakeConnection:
+    def __init__(self, service):
+        self.service = service
+        self.pending = None
+
+    def request(self, method, uri, body=None, headers=None):
+        self.pending = (method, uri, body)
+
+    def getresponse(self):
+        method, uri, body = self.pending
+        self.pending = None
+        return self.service.handle(method, uri, body)
+
+    def close(self):
+        pass
+
+
+class FakeAdmin(Admin):
+    """
+    `Admin` client talking to a `FakeDuo` instead of the DUO API.
+
+    Budget, keep-alive handling and statistics of the real client stay in
+    place, only the HTTPS connection is replaced.
+    """
+
+    def __init__(self, service):
+        super().__init__(
+            ikey="DIBENCHMARK000000000",
+            skey="benchmark" * 5,
+            host="api-bench.duosecurity.test",
+        )
+        self.service = service
+        self.budget = SharedTokenBucket(rate=service.rate or 1000000)
+
+    def _connect(self):
+        conn = getattr(self.connections, "conn", None)
+        if conn is None:
+            conn = self.connections.conn = FakeConnection(self.service)
+        return conn
+
+
+class RosterServer:
+    """
+    Local HTTP server publishing a roster of usernames with an `ETag`.
+    """
+
+    def __init__(self, usernames):
+        self.usernames = list(usernames)
+        self.requests = Counter()
+        self.etag = f'"{uuid.uuid4().hex}"'
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests["GET"] += 1
+                if self.headers.get("If-None-Match") == server.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = json.dumps(
+                    {"result": [{"benutzername": u} for u in server.usernames]}
+                ).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", server.etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/roster?date={{today}}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,297 @@
+"""
+Time the reconciliation tasks against generated directories.
+
+Runs `form`, `synchronize`, `refresh`, `enrollment_timeout` and `cleanup`
+for every requested directory size against an in-memory LDAP directory, a
+fake DUO Admin API and a local roster server. For every task the wall time,
+the number of database queries, LDAP operations, DUO requests and roster
+requests and the peak of traced Python memory are reported.
+
+The tasks need the models of the application, so this has to run inside a
+project that has `outpost.django.mfa` installed. A separate test database is
+created and dropped again::
+
+    DJANGO_SETTINGS_MODULE=outpost.settings python benchmarks/run.py \\
+        --sizes 1000 10000 100000 --json results.json
+
+Results written with `--json` can be compared between revisions.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import (
+    ExitStack,
+    contextmanager,
+)
+from datetime import timedelta
+from unittest import mock
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate(size, seed, interval):
+    """
+    Build the fake services for a directory of `size` persons.
+
+    Of every 100 persons one is new (neither in the MFA group nor in DUO),
+    five are in DUO but did not enroll within `interval` and three of those
+    are already locked. One in 200 enrolled persons still has a lock that
+    has to be removed, one in 50 has a phone that was never activated. One
+    percent of all persons are listed in the roster.
+    """
+    from fakes import (
+        Directory,
+        FakeDuo,
+    )
+
+    random.seed(seed)
+    directory = Directory()
+    duo = FakeDuo()
+    now = time.time()
+    expired = now - (interval + timedelta(days=7)).total_seconds()
+    users = list()
+    locked = list()
+    roster = list()
+    for i in range(size):
+        username = f"b{i:07d}"
+        groups = [directory.users_group]
+        slot = i % 100
+        if slot == 0:
+            groups = []
+        elif slot < 6:
+            duo.add_user(username, False, int(expired), [("+4300000000", True)])
+            if slot < 4:
+                groups.append(directory.locked_group)
+                locked.append(username)
+        else:
+            phones = [("+4300000000", True)]
+            if i % 50 == 7:
+                phones.append(("+4300000001", False))
+            duo.add_user(username, True, int(expired), phones)
+            if i % 200 == 9:
+                locked.append(username)
+        if random.random() < 0.01:
+            roster.append(username)
+        users.append((username, groups))
+    directory.populate(users)
+    return directory, duo, [u for u, _ in users], locked, roster
+
+
+def prepare_database(usernames, locked):
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+
+    from outpost.django.mfa.models import (
+        DuoUserState,
+        LockedUser,
+        PendingOperation,
+    )
+
+    User = get_user_model()
+    User.objects.all().delete()
+    DuoUserState.objects.all().delete()
+    PendingOperation.objects.all().delete()
+    User.objects.bulk_create(
+        (
+            User(username=u, first_name=u.title(), last_name="Benchmark")
+            for u in usernames
+        ),
+        batch_size=1000,
+    )
+    users = User.objects.filter(username__in=locked)
+    LockedUser.objects.bulk_create(
+        (LockedUser(local=u, locked=timezone.now()) for u in users.iterator()),
+        batch_size=1000,
+    )
+
+
+@contextmanager
+def count_queries(counter):
+    from django.db import connection
+
+    def wrapper(execute, sql, params, many, context):
+        counter["queries"] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        yield
+
+
+@contextmanager
+def eager(app):
+    """
+    Run tasks dispatched by the benchmarked tasks in the current process.
+    """
+    previous = app.conf.task_always_eager, app.conf.task_eager_propagates
+    app.conf.task_always_eager, app.conf.task_eager_propagates = True, False
+    try:
+        yield
+    finally:
+        app.conf.task_always_eager, app.conf.task_eager_propagates = previous
+
+
+def measure(name, size, func, services, warm):
+    from django.core.cache import caches
+
+    directory, duo, roster = services
+    if not warm:
+        for cache in caches.all():
+            cache.clear()
+    directory.operations.clear()
+    duo.requests.clear()
+    roster.requests.clear()
+    counter = Counter()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with count_queries(counter):
+        func()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "task": name,
+        "users": size,
+        "seconds": round(seconds, 3),
+        "queries": counter["queries"],
+        "ldap": sum(directory.operations.values()),
+        "duo": sum(v for k, v in duo.requests.items() if k != "throttled"),
+        "throttled": duo.requests["throttled"],
+        "http": sum(roster.requests.values()),
+        "peak_mb": round(peak / 2 ** 20, 1),
+    }
+
+
+def run(size, args):
+    import isodate
+    from django.test import override_settings
+
+    from fakes import (
+        DirectoryPool,
+        FakeAdmin,
+        RosterServer,
+    )
+    from outpost.django.mfa import tasks
+
+    interval = isodate.parse_duration(args.interval)
+    directory, duo, usernames, locked, roster = generate(size, args.seed, interval)
+    duo.latency = args.latency
+    duo.rate = args.rate
+    prepare_database(usernames, locked)
+    api = FakeAdmin(duo)
+    results = list()
+    with ExitStack() as stack:
+        server = stack.enter_context(RosterServer(roster))
+        stack.enter_context(
+            override_settings(
+                CACHES={
+                    "default": {
+                        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                        "LOCATION": "mfa-benchmark",
+                    }
+                },
+                MFA_LDAP_HOST=directory.host,
+                MFA_LDAP_BASE=directory.base,
+                MFA_LDAP_GROUP_USERS=directory.users_group,
+                MFA_LDAP_GROUP_USERS_LOCKED=directory.locked_group,
+                MFA_DUO_API_HOST=api.host,
+                MFA_DUO_DIRECTORY_KEY="DDBENCHMARK000000000",
+            )
+        )
+        stack.enter_context(mock.patch.object(tasks, "pool", DirectoryPool(directory)))
+        stack.enter_context(mock.patch.object(tasks, "client", lambda: api))
+        stack.enter_context(eager(tasks.UserTasks.form.app))
+        services = (directory, duo, server)
+        plan = (
+            ("form", lambda: tasks.UserTasks.form(server.url, directory.people)),
+            ("synchronize", lambda: tasks.UserTasks.synchronize(directory.people)),
+            ("refresh", lambda: tasks.UserTasks.refresh()),
+            (
+                "enrollment_timeout",
+                lambda: tasks.UserTasks.enrollment_timeout(
+                    directory.people, args.interval
+                ),
+            ),
+            ("cleanup", lambda: tasks.UserTasks.cleanup(restart=True)),
+        )
+        for name, func in plan:
+            if args.tasks and name not in args.tasks:
+                continue
+            result = measure(name, size, func, services, args.warm)
+            report(result)
+            results.append(result)
+    return results
+
+
+COLUMNS = (
+    ("task", "<20"),
+    ("users", ">8"),
+    ("seconds", ">9"),
+    ("queries", ">8"),
+    ("ldap", ">7"),
+    ("duo", ">7"),
+    ("throttled", ">9"),
+    ("http", ">5"),
+    ("peak_mb", ">8"),
+)
+
+
+def report(result=None):
+    if result is None:
+        print(" ".join(f"{name:{fmt}}" for name, fmt in COLUMNS))
+        return
+    print(" ".join(f"{result[name]:{fmt}}" for name, fmt in COLUMNS), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument(
+        "--tasks",
+        nargs="+",
+        choices=("form", "synchronize", "refresh", "enrollment_timeout", "cleanup"),
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="DUO response latency in seconds"
+    )
+    parser.add_argument(
+        "--rate", type=int, default=50, help="DUO requests allowed per second"
+    )
+    parser.add_argument("--interval", default="P14D", help="enrollment window")
+    parser.add_argument("--warm", action="store_true", help="keep caches between tasks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    django.setup()
+
+    from django.test.utils import (
+        setup_databases,
+        setup_test_environment,
+        teardown_databases,
+        teardown_test_environment,
+    )
+
+    setup_test_environment(debug=False)
+    databases = setup_databases(verbosity=0, interactive=False)
+    results = list()
+    try:
+        report()
+        for size in args.sizes:
+            results.extend(run(size, args))
+    finally:
+        teardown_databases(databases, verbosity=0)
+        teardown_test_environment()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
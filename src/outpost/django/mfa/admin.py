@@ -4,6 +4,7 @@ from django.contrib.admin.models import (
     LogEntry,
 )
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 
 from . import (
@@ -53,19 +54,26 @@ class LockedUserAdmin(admin.ModelAdmin):
         return request.user.has_perm(f"{self.opts.app_label}.unlock")
 
     def unlock(self, request, queryset):
-        for user in queryset:
-            tasks.UserTasks().unlock.apply_async((user.pk,), queue="maintainance")
-            LogEntry.objects.log_action(
-                user_id=request.user.id,
-                content_type_id=ContentType.objects.get_for_model(user.__class__).pk,
-                object_id=user.id,
-                object_repr=user.username,
-                action_flag=DELETION,
+        users = list(queryset.select_related("local"))
+        with transaction.atomic():
+            tasks.enqueue(
+                ((models.PendingOperation.UNLOCK, user.username) for user in users),
+                queue="maintainance",
             )
+            for user in users:
+                LogEntry.objects.log_action(
+                    user_id=request.user.id,
+                    content_type_id=ContentType.objects.get_for_model(
+                        user.__class__
+                    ).pk,
+                    object_id=user.id,
+                    object_repr=user.username,
+                    action_flag=DELETION,
+                )
         self.message_user(
             request,
             "%i successfully queued for unlocking. Please check again in a moment to see if they are gone from the list."
-            % queryset.count(),
+            % len(users),
         )
 
     unlock.short_description = _("Unlock selected users for new enrollment")
@@ -7,12 +7,45 @@ class MFAAppConf(AppConf):
     DUO_SKEY = None
     DUO_API_HOST = None
     DUO_DIRECTORY_KEY = None
+    DUO_PAGE_SIZE = 300
+    DUO_CACHE = "default"
+    DUO_CACHE_TIMEOUT = 900
+    DUO_RATE_LIMIT = 2
+    DUO_RATE_BURST = 10
+    DUO_ACTIVATION_WORKERS = 4
+    DUO_ACTIVATION_ATTEMPTS = 10
+    DUO_CLEANUP_WORKERS = 4
+    DUO_CLEANUP_CHUNK_SIZE = 100
+    DUO_STATE_MAX_AGE = 3600
     LDAP_HOST = None
     LDAP_BASE = None
     LDAP_BIND_DN = None
     LDAP_PASSWORD = None
     LDAP_GROUP_USERS = None
     LDAP_GROUP_USERS_LOCKED = None
+    LDAP_POOL_SIZE = 4
+    LDAP_POOL_LIFETIME = 900
+    LDAP_POOL_HEALTHCHECK = 30
+    LDAP_SCHEMA_CACHE = "default"
+    LDAP_SCHEMA_TIMEOUT = 86400
+    LDAP_MODIFY_BATCH_SIZE = 250
+    LDAP_PAGE_SIZE = 500
+    LDAP_FILTER_CHUNK_SIZE = 100
+    LDAP_PERMISSIVE_MODIFY = True
+    LDAP_FULL_SCAN_INTERVAL = "P1D"
+    OUTBOX_ATTEMPTS = 10
+    OUTBOX_BATCH_SIZE = 1000
+    OUTBOX_CACHE = "default"
+    OUTBOX_CLAIM_TIMEOUT = 3600
+    OUTBOX_TIMEOUT = 3600
+    METRICS_BACKENDS = ("outpost.django.mfa.metrics.LogBackend",)
+    PROGRESS_CACHE = "default"
+    PROGRESS_INTERVAL = 1.0
+    PROGRESS_EVERY = 1000
+    ROSTER_CACHE = "default"
+    ROSTER_CACHE_TIMEOUT = 86400
+    ROSTER_TIMEOUT = 60
+    TASK_SHARDS = 1
     ENROLLMENT_URL = "http://localhost"
     ENROLLMENT_PHOTO_EXPIRATION_DAYS = 14
     ENROLLMENT_WINDOW_DAYS = 3
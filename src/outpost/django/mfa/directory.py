@@ -0,0 +1,498 @@
+import hashlib
+import logging
+import os
+import re
+import string
+import threading
+import time
+import zlib
+from collections import (
+    Counter,
+    namedtuple,
+)
+from contextlib import contextmanager
+from queue import (
+    Empty,
+    Full,
+    LifoQueue,
+    Queue,
+)
+
+from ldap3 import (
+    ALL,
+    BASE,
+    NONE,
+    SAFE_SYNC,
+    SUBTREE,
+    Connection,
+    DsaInfo,
+    SchemaInfo,
+    Server,
+)
+from ldap3.core.exceptions import (
+    LDAPCommunicationError,
+    LDAPException,
+    LDAPSessionTerminatedByServerError,
+)
+from ldap3.core.results import RESULT_SUCCESS
+from ldap3.utils.conv import escape_filter_chars
+
+from .conf import settings
+from .metrics import metrics
+from .utils import (
+    chunked,
+    get_cache,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaCache:
+    """
+    Server info and schema of the directory, shared between workers.
+
+    Both are kept as compressed JSON in the configured Django cache so that
+    only the first connection after expiry has to read them from the server.
+    """
+
+    version = 1
+
+    def __init__(self, alias=None, timeout=None):
+        self._alias = alias
+        self._timeout = timeout
+
+    @property
+    def cache(self):
+        return get_cache(self._alias or settings.MFA_LDAP_SCHEMA_CACHE)
+
+    @property
+    def key(self):
+        return f"mfa:ldap:schema:{self.version}:{settings.MFA_LDAP_HOST}"
+
+    def load(self):
+        cache = self.cache
+        if not cache:
+            return None
+        data = cache.get(self.key)
+        if not data:
+            return None
+        info, schema = (zlib.decompress(d).decode("utf-8") for d in data)
+        server = Server(settings.MFA_LDAP_HOST, get_info=NONE)
+        server.attach_dsa_info(DsaInfo.from_json(info))
+        server.attach_schema_info(SchemaInfo.from_json(schema))
+        return server
+
+    def store(self, server):
+        cache = self.cache
+        if not cache or not server.info or not server.schema:
+            return
+        data = tuple(
+            zlib.compress(d.to_json().encode("utf-8"))
+            for d in (server.info, server.schema)
+        )
+        cache.set(self.key, data, self._timeout or settings.MFA_LDAP_SCHEMA_TIMEOUT)
+        logger.debug(f"Cached LDAP schema for {settings.MFA_LDAP_HOST}")
+
+
+class ConnectionPool:
+    """
+    Per-process pool of bound LDAP connections.
+
+    Connections are handed out in LIFO order so that a small number of them
+    stays warm. Idle connections are probed before reuse and rebound if the
+    server dropped them, connections past their lifetime are replaced. The
+    pool never blocks: if all pooled connections are in use a new one is
+    opened and discarded on release once the pool is full again.
+    """
+
+    def __init__(self, size=None, lifetime=None, healthcheck=None):
+        self._size = size
+        self._lifetime = lifetime
+        self._healthcheck = healthcheck
+        self.stats = Counter()
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _prepare(self):
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            # Connections inherited through fork share their sockets with the
+            # parent and must not be used or closed by the child.
+            self.size = self._size or settings.MFA_LDAP_POOL_SIZE
+            self.lifetime = self._lifetime or settings.MFA_LDAP_POOL_LIFETIME
+            self.healthcheck = self._healthcheck or settings.MFA_LDAP_POOL_HEALTHCHECK
+            self.idle = LifoQueue(maxsize=self.size)
+            self.server = None
+            self.stats.clear()
+            self.pid = pid
+
+    def get_server(self):
+        if not self.server:
+            self.server = schema_cache.load()
+        if not self.server:
+            self.server = Server(settings.MFA_LDAP_HOST, get_info=ALL)
+        return self.server
+
+    def _open(self):
+        logger.debug(
+            f"Opening LDAP connection (hits={self.stats['hits']}, "
+            f"misses={self.stats['misses']}, discards={self.stats['discards']})"
+        )
+        server = self.get_server()
+        conn = Connection(
+            server,
+            settings.MFA_LDAP_BIND_DN,
+            settings.MFA_LDAP_PASSWORD,
+            auto_bind=True,
+            auto_range=True,
+            client_strategy=SAFE_SYNC,
+        )
+        if server.get_info == ALL:
+            # Schema was read during the bind, later connections and other
+            # workers reuse it.
+            schema_cache.store(server)
+            server.get_info = NONE
+        now = time.monotonic()
+        return [conn, now, now]
+
+    def _alive(self, conn):
+        try:
+            status, _, _, _ = conn.search(
+                "", "(objectClass=*)", BASE, attributes=["1.1"]
+            )
+        except LDAPException:
+            return False
+        return status
+
+    def _revive(self, conn):
+        try:
+            if conn.closed:
+                conn.open()
+            # SAFE_SYNC connections return a result tuple, which is always
+            # true, so the status has to be unpacked.
+            status, _, _, _ = conn.bind()
+            if not status:
+                return False
+        except LDAPException as e:
+            logger.debug(f"Could not rebind pooled LDAP connection: {e}")
+            return False
+        self.stats["rebinds"] += 1
+        metrics.count("ldap_pool", result="rebind")
+        return True
+
+    def _discard(self, item):
+        self.stats["discards"] += 1
+        metrics.count("ldap_pool", result="discard")
+        try:
+            item[0].unbind()
+        except LDAPException:
+            pass
+
+    def _checkout(self):
+        self._prepare()
+        now = time.monotonic()
+        while True:
+            try:
+                item = self.idle.get_nowait()
+            except Empty:
+                self.stats["misses"] += 1
+                metrics.count("ldap_pool", result="miss")
+                return self._open()
+            conn, created, used = item
+            if now - created > self.lifetime:
+                self._discard(item)
+                continue
+            if conn.closed or not conn.bound:
+                healthy = self._revive(conn)
+            elif now - used > self.healthcheck:
+                healthy = self._alive(conn) or self._revive(conn)
+            else:
+                healthy = True
+            if not healthy:
+                self._discard(item)
+                continue
+            self.stats["hits"] += 1
+            metrics.count("ldap_pool", result="hit")
+            return item
+
+    def _checkin(self, item):
+        if self.pid != os.getpid():
+            return
+        item[2] = time.monotonic()
+        try:
+            self.idle.put_nowait(item)
+        except Full:
+            self._discard(item)
+
+    @contextmanager
+    def connection(self):
+        item = self._checkout()
+        try:
+            yield item[0]
+        except (LDAPCommunicationError, LDAPSessionTerminatedByServerError):
+            self._discard(item)
+            raise
+        except BaseException:
+            self._checkin(item)
+            raise
+        self._checkin(item)
+
+
+class MembershipIndex:
+    """
+    Case-insensitive set of the member DNs of a group.
+
+    DNs are normalized and only a 64 bit digest of each one is kept, which
+    keeps groups with tens of thousands of members small in memory while
+    allowing constant time membership tests.
+    """
+
+    __slots__ = ("digests",)
+
+    separator = re.compile(r"\s*(?<!\\),\s*")
+
+    def __init__(self, members=()):
+        self.digests = {self.digest(m) for m in members}
+
+    @classmethod
+    def from_group(cls, conn, group):
+        status, result, response, _ = conn.search(
+            group, "(objectClass=*)", BASE, attributes=["member"]
+        )
+        if not status or not response:
+            raise LDAPException(f"Could not read members of {group}: {result}")
+        return cls(response[0]["attributes"].get("member", []))
+
+    @classmethod
+    def normalize(cls, dn):
+        return cls.separator.sub(",", dn.strip()).lower()
+
+    @classmethod
+    def digest(cls, dn):
+        return int.from_bytes(
+            hashlib.blake2b(cls.normalize(dn).encode("utf-8"), digest_size=8).digest(),
+            "big",
+        )
+
+    def add(self, dn):
+        self.digests.add(self.digest(dn))
+
+    def __contains__(self, dn):
+        return self.digest(dn) in self.digests
+
+    def __len__(self):
+        return len(self.digests)
+
+
+class Entry(namedtuple("Entry", ("dn", "attributes"))):
+    __slots__ = ()
+
+    def value(self, name):
+        value = self.attributes.get(name)
+        if isinstance(value, list):
+            return value[0] if value else None
+        return value
+
+    def values(self, name):
+        value = self.attributes.get(name)
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return value
+        return [value]
+
+    def member_of(self, group):
+        group = MembershipIndex.normalize(group)
+        return any(
+            MembershipIndex.normalize(g) == group for g in self.values("memberOf")
+        )
+
+
+PAGED_RESULTS = "1.2.840.113556.1.4.319"
+PERMISSIVE_MODIFY = "1.2.840.113556.1.4.1413"
+
+
+def paged_search(conn, base, query, attributes, page_size=None):
+    """
+    Yield `Entry` objects below `base` using the Simple Paged Results control.
+
+    The next page is requested by a background thread while the current one
+    is being consumed, at most one page is held ahead of the consumer.
+    """
+    page_size = page_size or settings.MFA_LDAP_PAGE_SIZE
+    pages = Queue(maxsize=1)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def fetch():
+        cookie = None
+        try:
+            while True:
+                with metrics.timer("ldap_search"):
+                    status, result, response, _ = conn.search(
+                        base,
+                        query,
+                        SUBTREE,
+                        attributes=list(attributes),
+                        paged_size=page_size,
+                        paged_cookie=cookie,
+                    )
+                # Searches without matching entries report a false status
+                # as well, only the result code tells them from failures.
+                if not status and result.get("result") != RESULT_SUCCESS:
+                    raise LDAPException(f"Search in {base} failed: {result}")
+                page = [
+                    Entry(r["dn"], r["attributes"])
+                    for r in response
+                    if r["type"] == "searchResEntry"
+                ]
+                if not put(page):
+                    return
+                cookie = (
+                    result.get("controls", {})
+                    .get(PAGED_RESULTS, {})
+                    .get("value", {})
+                    .get("cookie")
+                )
+                if not cookie:
+                    break
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    thread = threading.Thread(target=fetch, daemon=True)
+    thread.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+    finally:
+        stop.set()
+        thread.join()
+
+
+def find_users(conn, base, usernames, attributes=("cn",), chunk_size=None):
+    """
+    Look up persons by `cn` with one OR-filter search per chunk of usernames.
+
+    Returns a dictionary of `Entry` objects keyed by lowercase username.
+    """
+    chunk_size = chunk_size or settings.MFA_LDAP_FILTER_CHUNK_SIZE
+    attributes = set(attributes) | {"cn"}
+    entries = dict()
+    for chunk in chunked(usernames, chunk_size):
+        names = "".join(f"(cn={escape_filter_chars(u)})" for u in chunk)
+        query = f"(&(objectClass=person)(|{names}))"
+        for entry in paged_search(conn, base, query, attributes):
+            entries[entry.value("cn").lower()] = entry
+    return entries
+
+
+def shard_filters(count, alphabet=string.ascii_lowercase):
+    """
+    Split persons into `count` disjoint filters on the first letter of `cn`.
+
+    Letters are assigned in contiguous ranges, the last filter also matches
+    names starting with any character outside of `alphabet`. Matching of
+    `cn` is case-insensitive, so together the filters cover all entries.
+
+    >>> shard_filters(2, "ab")
+    ['(|(cn=a*))', '(|(cn=b*)(!(|(cn=a*)(cn=b*))))']
+    """
+    count = max(1, min(count, len(alphabet)))
+    rest = "(!(|{}))".format("".join(f"(cn={c}*)" for c in alphabet))
+    size, extra = divmod(len(alphabet), count)
+    filters = list()
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        terms = "".join(f"(cn={c}*)" for c in alphabet[start:end])
+        if i == count - 1:
+            terms += rest
+        filters.append(f"(|{terms})")
+        start = end
+    return filters
+
+
+def highest_usn(conn):
+    """
+    Return the DNS name and highest committed USN of the connected server.
+
+    Both are `None` if the server does not publish them in its root DSE.
+    """
+    status, _, response, _ = conn.search(
+        "",
+        "(objectClass=*)",
+        BASE,
+        attributes=["dnsHostName", "highestCommittedUSN"],
+    )
+    if not status or not response:
+        return None, None
+    attributes = response[0]["attributes"]
+    usn = attributes.get("highestCommittedUSN")
+    if not usn:
+        return None, None
+    return attributes.get("dnsHostName"), int(usn)
+
+
+def modify_members(conn, group, operation, dns, batch_size=None):
+    """
+    Add or remove member DNs of a group in multi-value modify operations.
+
+    DNs are sent in chunks of `batch_size`. If a chunk is rejected it is
+    retried one DN at a time so that a single bad value does not fail the
+    whole chunk. With `MFA_LDAP_PERMISSIVE_MODIFY` the server is asked to
+    ignore values that are already present or absent. Returns the DNs that
+    were modified successfully.
+    """
+    batch_size = batch_size or settings.MFA_LDAP_MODIFY_BATCH_SIZE
+    if settings.MFA_LDAP_PERMISSIVE_MODIFY:
+        controls = [(PERMISSIVE_MODIFY, False, None)]
+    else:
+        controls = None
+    done = list()
+    for chunk in chunked(dns, batch_size):
+        with metrics.timer("ldap_modify", operation=operation):
+            status, result, _, _ = conn.modify(
+                group, {"member": [(operation, chunk)]}, controls=controls
+            )
+        if status:
+            done.extend(chunk)
+            continue
+        if len(chunk) == 1:
+            logger.error(f"Could not modify {chunk[0]} in {group}: {result}")
+            continue
+        logger.warning(
+            f"Modifying {len(chunk)} members of {group} failed, retrying one by one: {result}"
+        )
+        for dn in chunk:
+            with metrics.timer("ldap_modify", operation=operation):
+                status, result, _, _ = conn.modify(
+                    group, {"member": [(operation, [dn])]}, controls=controls
+                )
+            if status:
+                done.append(dn)
+            else:
+                logger.error(f"Could not modify {dn} in {group}: {result}")
+    return done
+
+
+schema_cache = SchemaCache()
+pool = ConnectionPool()
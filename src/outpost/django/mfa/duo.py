@@ -0,0 +1,515 @@
+import http.client
+import logging
+import pickle
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import duo_client
+
+from .conf import settings
+from .metrics import metrics
+from .utils import (
+    chunked,
+    get_cache,
+    per_process,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DuoUser:
+    """
+    Compact record of a DUO user with only the fields used by the tasks.
+
+    Phones without a number are dropped, the remaining ones are kept as
+    `(phone_id, activated)` pairs.
+    """
+
+    __slots__ = ("username", "user_id", "is_enrolled", "created", "phones")
+
+    def __init__(self, username, user_id, is_enrolled, created, phones=()):
+        self.username = username
+        self.user_id = user_id
+        self.is_enrolled = is_enrolled
+        self.created = created
+        self.phones = phones
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(
+            data.get("username"),
+            data.get("user_id"),
+            bool(data.get("is_enrolled")),
+            data.get("created"),
+            tuple(
+                (p.get("phone_id"), bool(p.get("activated")))
+                for p in data.get("phones", [])
+                if p.get("number")
+            ),
+        )
+
+    def __reduce__(self):
+        return (
+            DuoUser,
+            (self.username, self.user_id, self.is_enrolled, self.created, self.phones),
+        )
+
+    def __repr__(self):
+        return f"<DuoUser {self.username}>"
+
+
+def iter_users(api, page_size=None, offset=0):
+    """
+    Yield all DUO users as `DuoUser` records, one API page at a time.
+
+    Listing starts at `offset`, the position of a user in the listing of
+    DUO, which is stable as long as no users are added or removed.
+    """
+    params = {"limit": str(page_size or settings.MFA_DUO_PAGE_SIZE)}
+    while offset is not None:
+        params["offset"] = str(offset)
+        response, data = api.api_call("GET", "/admin/v1/users", params)
+        users, metadata = api.parse_json_response_and_metadata(response, data)
+        offset = metadata.get("next_offset")
+        for user in users:
+            yield DuoUser.from_api(user)
+
+
+def user_index(api, page_size=None):
+    return {u.username: u for u in iter_users(api, page_size)}
+
+
+class DirectorySnapshot:
+    """
+    Username index of all DUO users shared between tasks and workers.
+
+    The index is stored compressed in the configured Django cache and
+    expires after `MFA_DUO_CACHE_TIMEOUT` seconds. Tasks that change users
+    in DUO patch the affected records so the snapshot stays usable until it
+    expires. Without a usable cache backend every call reads from DUO.
+
+    The snapshot is good enough to decide which users to add or lock, but
+    not for destructive changes: `PhoneCleanup` reads current records.
+    """
+
+    version = 1
+
+    def __init__(self, alias=None, timeout=None):
+        self._alias = alias
+        self._timeout = timeout
+
+    @property
+    def cache(self):
+        return get_cache(self._alias or settings.MFA_DUO_CACHE)
+
+    @property
+    def key(self):
+        return f"mfa:duo:users:{self.version}:{settings.MFA_DUO_API_HOST}"
+
+    def load(self):
+        cache = self.cache
+        if not cache:
+            return None
+        data = cache.get(self.key)
+        if data is None:
+            return None
+        return {u.username: u for u in pickle.loads(zlib.decompress(data))}
+
+    def store(self, users):
+        cache = self.cache
+        if not cache:
+            return
+        data = zlib.compress(
+            pickle.dumps(list(users.values()), pickle.HIGHEST_PROTOCOL)
+        )
+        cache.set(self.key, data, self._timeout or settings.MFA_DUO_CACHE_TIMEOUT)
+
+    def get(self, api):
+        users = self.load()
+        if users is not None:
+            metrics.count("duo_snapshot", result="hit")
+            return users
+        metrics.count("duo_snapshot", result="miss")
+        logger.debug("Reading DUO users into snapshot")
+        with metrics.timer("duo_users"):
+            users = user_index(api)
+        self.store(users)
+        return users
+
+    def patch(self, records):
+        """
+        Replace or insert records in a cached snapshot, if there is one.
+        """
+        records = list(records)
+        if not records:
+            return
+        users = self.load()
+        if users is None:
+            return
+        users.update((u.username, u) for u in records)
+        self.store(users)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the request rate of one process.
+
+    `penalize` blocks all consumers for a while, which is used to back off
+    the whole pool when DUO answers with HTTP 429.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if now >= self.blocked and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.blocked - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def penalize(self, seconds):
+        with self.lock:
+            self.blocked = max(self.blocked, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class ActivationPool:
+    """
+    Activate users in DUO from a bounded pool of threads.
+
+    Requests draw from the request budget of the `Admin` client. A rate
+    limited response pauses all users of that budget with exponential
+    backoff. Server errors and network failures are retried for the user
+    alone with waits between `min_wait` and `max_wait` seconds. Errors that
+    persist or are permanent, like unknown users, are recorded per user in
+    `failed` instead of stopping the caller.
+    """
+
+    min_wait = 4
+    max_wait = 10
+
+    def __init__(self, api, workers=None, attempts=None):
+        self.api = api
+        self.workers = workers or settings.MFA_DUO_ACTIVATION_WORKERS
+        self.attempts = attempts or settings.MFA_DUO_ACTIVATION_ATTEMPTS
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="duo-activation"
+        )
+        self.futures = dict()
+        self.activated = list()
+        self.failed = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.join()
+
+    def _activate(self, username):
+        error = "rate limited"
+        for attempt in range(self.attempts):
+            try:
+                logger.info(f"Activating user {username} for DUO")
+                data = self.api.sync_user(username, settings.MFA_DUO_DIRECTORY_KEY)
+            except RuntimeError as e:
+                status = getattr(e, "status", None)
+                if status == 429:
+                    delay = 2 ** attempt
+                    logger.warning(
+                        f"DUO rate limit hit, pausing activations for {delay}s"
+                    )
+                    self.api.budget.penalize(delay)
+                    continue
+                if status is not None and status < 500:
+                    raise
+                error = e
+            except OSError as e:
+                error = e
+            else:
+                return DuoUser.from_api(data)
+            if attempt + 1 < self.attempts:
+                delay = min(max(2 ** attempt, self.min_wait), self.max_wait)
+                logger.warning(
+                    f"Could not activate {username} for DUO, retrying in {delay}s: "
+                    f"{error}"
+                )
+                time.sleep(delay)
+        raise RuntimeError(f"Giving up after {self.attempts} attempts: {error}")
+
+    def _collect(self, futures):
+        for future in futures:
+            username = self.futures.pop(future)
+            try:
+                self.activated.append(future.result())
+            except Exception as e:
+                logger.error(f"Could not activate {username} for DUO: {e}")
+                self.failed[username] = str(e)
+
+    def submit(self, username):
+        if len(self.futures) >= self.workers * 2:
+            done, _ = wait(self.futures, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        self.futures[self.executor.submit(self._activate, username)] = username
+
+    def join(self):
+        done, _ = wait(self.futures)
+        self._collect(done)
+        self.executor.shutdown()
+
+    @property
+    def summary(self):
+        return {"activated": len(self.activated), "failed": self.failed}
+
+
+class PhoneCleanup:
+    """
+    Remove phones that have a number but were never activated.
+
+    Users are streamed from DUO in chunks, deletions of a chunk run
+    concurrently in a bounded thread pool under the shared request budget.
+    Unlike other tasks this does not read the shared snapshot: it may be
+    older than a phone activated in the meantime, which would be deleted.
+    After each chunk the listing offset of the next user is stored as
+    checkpoint in the cache so that an interrupted run continues there.
+    Users added or removed in DUO meanwhile shift the listing, those missed
+    are cleaned up by the next complete run. In dry-run mode nothing is
+    deleted and the checkpoint is left untouched.
+    """
+
+    checkpoint_timeout = 86400
+
+    def __init__(self, api, workers=None, chunk_size=None, dry_run=False):
+        self.api = api
+        self.workers = workers or settings.MFA_DUO_CLEANUP_WORKERS
+        self.chunk_size = chunk_size or settings.MFA_DUO_CLEANUP_CHUNK_SIZE
+        self.dry_run = dry_run
+        self.stats = Counter()
+
+    @property
+    def cache(self):
+        return snapshot.cache
+
+    @property
+    def key(self):
+        return f"mfa:duo:cleanup:offset:{settings.MFA_DUO_API_HOST}"
+
+    def _delete(self, user, phone_id):
+        logger.warning(f"Remove phone {phone_id} from user {user.user_id}")
+        self.api.delete_user_phone(user.user_id, phone_id)
+        return user, phone_id
+
+    def _process(self, executor, users):
+        futures = list()
+        for user in users:
+            self.stats["users"] += 1
+            for phone_id, activated in user.phones:
+                if activated:
+                    continue
+                self.stats["phones"] += 1
+                if not self.dry_run:
+                    futures.append(executor.submit(self._delete, user, phone_id))
+        removed = dict()
+        for future in futures:
+            try:
+                user, phone_id = future.result()
+            except RuntimeError as e:
+                logger.error(f"Could not remove phone: {e}")
+                self.stats["failed"] += 1
+            else:
+                removed.setdefault(user, set()).add(phone_id)
+                self.stats["removed"] += 1
+        for user, phone_ids in removed.items():
+            user.phones = tuple(p for p in user.phones if p[0] not in phone_ids)
+        return removed
+
+    def run(self, restart=False):
+        start = time.monotonic()
+        cache = self.cache
+        checkpoint = 0
+        if cache and not restart:
+            checkpoint = cache.get(self.key, 0)
+        if checkpoint:
+            logger.info(f"Resuming phone cleanup at user {checkpoint}")
+        offset = checkpoint
+        cleaned = list()
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="duo-cleanup"
+            ) as executor:
+                for chunk in chunked(
+                    iter_users(self.api, offset=checkpoint), self.chunk_size
+                ):
+                    cleaned.extend(self._process(executor, chunk))
+                    offset += len(chunk)
+                    if cache and not self.dry_run:
+                        cache.set(self.key, offset, self.checkpoint_timeout)
+        finally:
+            # Rewriting the snapshot is as expensive as reading it, so it is
+            # patched once with all users whose phones were removed.
+            snapshot.patch(cleaned)
+        if cache and not self.dry_run:
+            cache.delete(self.key)
+        return dict(
+            self.stats,
+            resumed=checkpoint or None,
+            dry_run=self.dry_run,
+            seconds=round(time.monotonic() - start, 3),
+        )
+
+
+class SharedTokenBucket:
+    """
+    Request budget for the DUO Admin API shared by all workers.
+
+    The bucket holds `rate` tokens and is refilled at the start of every
+    second. Tokens are taken with atomic increments of a per-second counter
+    in the Django cache, penalties are stored there as well so that a rate
+    limited worker pauses the whole cluster. Without a usable cache backend
+    a process-local `TokenBucket` is used instead.
+    """
+
+    def __init__(self, alias=None, rate=None, burst=None):
+        self._alias = alias
+        self.rate = rate or settings.MFA_DUO_RATE_LIMIT
+        self.local = TokenBucket(self.rate, burst or settings.MFA_DUO_RATE_BURST)
+
+    @property
+    def cache(self):
+        return get_cache(self._alias or settings.MFA_DUO_CACHE)
+
+    @property
+    def prefix(self):
+        return f"mfa:duo:budget:{settings.MFA_DUO_API_HOST}"
+
+    def acquire(self):
+        cache = self.cache
+        if not cache:
+            return self.local.acquire()
+        while True:
+            now = time.time()
+            blocked = cache.get(f"{self.prefix}:blocked")
+            if blocked and blocked > now:
+                time.sleep(blocked - now)
+                continue
+            key = f"{self.prefix}:{int(now)}"
+            cache.add(key, 0, 5)
+            try:
+                count = cache.incr(key)
+            except ValueError:
+                continue
+            if count <= self.rate:
+                return
+            time.sleep(int(now) + 1 - now)
+
+    def penalize(self, seconds):
+        cache = self.cache
+        if not cache:
+            return self.local.penalize(seconds)
+        until = time.time() + seconds
+        cache.set(f"{self.prefix}:blocked", until, int(seconds) + 1)
+
+
+class Admin(duo_client.Admin):
+    """
+    DUO Admin API client used by all tasks.
+
+    Every request takes a token from the shared request budget, each thread
+    keeps its HTTPS connection open for following requests and request
+    counts, rate limited responses and latency are collected in `stats`.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("ikey", settings.MFA_DUO_IKEY)
+        kwargs.setdefault("skey", settings.MFA_DUO_SKEY)
+        kwargs.setdefault("host", settings.MFA_DUO_API_HOST)
+        super().__init__(**kwargs)
+        self.budget = SharedTokenBucket()
+        self.connections = threading.local()
+        self.stats = Counter()
+
+    def _connect(self):
+        conn = getattr(self.connections, "conn", None)
+        if conn is None:
+            conn = super()._connect()
+            self.connections.conn = conn
+        return conn
+
+    def _disconnect(self, conn):
+        # Keep the connection open, http.client reconnects transparently if
+        # the server closed it.
+        pass
+
+    def _reset(self, conn):
+        """
+        Close `conn` and drop it, so the next request opens a new one.
+        """
+        conn.close()
+        if getattr(self.connections, "conn", None) is conn:
+            del self.connections.conn
+
+    def _attempt_single_request(self, conn, method, uri, body, headers):
+        self.budget.acquire()
+        start = time.monotonic()
+        try:
+            try:
+                response, data = super()._attempt_single_request(
+                    conn, method, uri, body, headers
+                )
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ):
+                # Idle keep-alive connection was dropped by the server before
+                # the request reached it.
+                conn.close()
+                self.stats["reconnects"] += 1
+                metrics.count("duo_reconnects")
+                response, data = super()._attempt_single_request(
+                    conn, method, uri, body, headers
+                )
+        except Exception:
+            # A connection left in the middle of a request refuses all
+            # further ones with CannotSendRequest.
+            self._reset(conn)
+            raise
+        elapsed = time.monotonic() - start
+        self.stats["requests"] += 1
+        self.stats["latency"] += elapsed
+        metrics.timing("duo_request", elapsed, method=method, status=response.status)
+        if response.status == self._RATE_LIMITED_RESP_CODE:
+            self.stats["throttled"] += 1
+            metrics.count("duo_throttled")
+            self.budget.penalize(self._INITIAL_BACKOFF_WAIT_SECS)
+        return response, data
+
+
+@per_process
+def client():
+    """
+    Return the `Admin` client of the current process.
+    """
+    return Admin()
+
+
+snapshot = DirectorySnapshot()
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.utils.module_loading import import_string
+
+from .conf import settings
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+
+class LogBackend:
+    """
+    Emit every measurement as a structured log record.
+
+    Records are logged at `DEBUG` level on `outpost.django.mfa.metrics` and
+    carry `metric`, `value` and `labels` as extra attributes for formatters
+    that ship them to a log pipeline.
+    """
+
+    def emit(self, kind, name, value, labels):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug(
+            f"{kind} {name} {value:.6g} {labels}",
+            extra={"metric": name, "kind": kind, "value": value, "labels": labels},
+        )
+
+    def timing(self, name, seconds, labels):
+        self.emit("timing", name, seconds, labels)
+
+    def count(self, name, value, labels):
+        self.emit("count", name, value, labels)
+
+
+class PrometheusBackend:
+    """
+    Record measurements in a `prometheus_client` registry.
+
+    Timings become histograms named `mfa_<name>_seconds`, counts become
+    counters exported as `mfa_<name>_total`. Metrics are registered on first
+    use in the default registry unless another one is passed.
+    """
+
+    def __init__(self, registry=None):
+        if not prometheus_client:
+            raise ImportError("prometheus_client is required for PrometheusBackend")
+        self.registry = registry or prometheus_client.REGISTRY
+        self.metrics = dict()
+        self.lock = threading.Lock()
+
+    def _metric(self, cls, name, labels):
+        if name not in self.metrics:
+            with self.lock:
+                if name not in self.metrics:
+                    self.metrics[name] = cls(
+                        name,
+                        name.replace("_", " "),
+                        sorted(labels),
+                        registry=self.registry,
+                    )
+        metric = self.metrics[name]
+        return metric.labels(**labels) if labels else metric
+
+    def timing(self, name, seconds, labels):
+        self._metric(
+            prometheus_client.Histogram, f"mfa_{name}_seconds", labels
+        ).observe(seconds)
+
+    def count(self, name, value, labels):
+        self._metric(prometheus_client.Counter, f"mfa_{name}", labels).inc(value)
+
+
+class Phases:
+    """
+    Time the consecutive phases of a task run.
+
+    Every call to `lap` records the time since the previous lap as a `phase`
+    timing labelled with the task and phase name, `done` records the whole
+    run as a `task` timing. The durations are kept in `seconds` so they can
+    be returned as part of the task result.
+    """
+
+    def __init__(self, metrics, task):
+        self.metrics = metrics
+        self.task = task
+        self.seconds = dict()
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.last = now
+        self.seconds[phase] = round(self.seconds.get(phase, 0) + elapsed, 3)
+        self.metrics.timing("phase", elapsed, task=self.task, phase=phase)
+
+    def done(self):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.timing("task", elapsed, task=self.task)
+        return self.seconds
+
+
+class Metrics:
+    """
+    Timers and counters around phases and external calls of the tasks.
+
+    Measurements are passed to the backends listed in
+    `MFA_METRICS_BACKENDS`, which are loaded on first use.
+    """
+
+    def __init__(self, backends=None):
+        self._backends = backends
+
+    @property
+    def backends(self):
+        if self._backends is None:
+            self._backends = [import_string(b)() for b in settings.MFA_METRICS_BACKENDS]
+        return self._backends
+
+    def count(self, name, value=1, **labels):
+        for backend in self.backends:
+            backend.count(name, value, labels)
+
+    def timing(self, name, seconds, **labels):
+        for backend in self.backends:
+            backend.timing(name, seconds, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start, **labels)
+
+    def phases(self, task):
+        return Phases(self, task)
+
+
+metrics = Metrics()
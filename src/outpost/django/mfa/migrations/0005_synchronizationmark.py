@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mfa", "0004_unlocknetwork"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SynchronizationMark",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("base", models.CharField(max_length=512, unique=True)),
+                ("server", models.CharField(max_length=256)),
+                ("usn", models.BigIntegerField()),
+                ("full", models.DateTimeField()),
+            ],
+        ),
+    ]
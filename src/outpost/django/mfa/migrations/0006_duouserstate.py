@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mfa", "0005_synchronizationmark"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DuoUserState",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("username", models.CharField(max_length=150, unique=True)),
+                ("user_id", models.CharField(max_length=64)),
+                ("enrolled", models.BooleanField(default=False)),
+                ("created", models.DateTimeField(null=True)),
+                ("seen", models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="duouserstate",
+            index=models.Index(
+                fields=["enrolled", "created"], name="mfa_duouser_enrolle_537602_idx"
+            ),
+        ),
+    ]
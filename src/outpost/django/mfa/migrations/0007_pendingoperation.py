@@ -0,0 +1,55 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mfa", "0006_duouserstate"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingOperation",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("lock", "Lock"),
+                            ("unlock", "Unlock"),
+                            ("activate", "Activate"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                ("username", models.CharField(max_length=150)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                (
+                    "due",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+                ("claimed", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="pendingoperation",
+            index=models.Index(
+                fields=["username", "operation"], name="mfa_pending_usernam_a84c4e_idx"
+            ),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from netfields import (
     CidrAddressField,
@@ -59,3 +60,51 @@ class UnlockNetwork(models.Model):
 
     def __str__(self):
         return f"{self.name} ({self.inet})"
+
+
+class SynchronizationMark(models.Model):
+    base = models.CharField(max_length=512, unique=True)
+    server = models.CharField(max_length=256)
+    usn = models.BigIntegerField()
+    full = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.base}: {self.usn} ({self.server})"
+
+
+class DuoUserState(models.Model):
+    username = models.CharField(max_length=150, unique=True)
+    user_id = models.CharField(max_length=64)
+    enrolled = models.BooleanField(default=False)
+    created = models.DateTimeField(null=True)
+    seen = models.DateTimeField(db_index=True)
+
+    class Meta:
+        indexes = (models.Index(fields=("enrolled", "created")),)
+
+    def __str__(self):
+        return self.username
+
+
+class PendingOperation(models.Model):
+    LOCK = "lock"
+    UNLOCK = "unlock"
+    ACTIVATE = "activate"
+    OPERATIONS = (
+        (LOCK, _("Lock")),
+        (UNLOCK, _("Unlock")),
+        (ACTIVATE, _("Activate")),
+    )
+
+    operation = models.CharField(max_length=16, choices=OPERATIONS)
+    username = models.CharField(max_length=150)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    due = models.DateTimeField(default=timezone.now, db_index=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = (models.Index(fields=("username", "operation")),)
+
+    def __str__(self):
+        return f"{self.operation} {self.username}"
@@ -0,0 +1,98 @@
+import hashlib
+import logging
+
+import requests
+
+from .conf import settings
+from .utils import (
+    get_cache,
+    per_process,
+)
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+
+@per_process
+def session():
+    """
+    Return the HTTP session of the current process.
+    """
+    return requests.Session()
+
+
+class Roster:
+    """
+    Usernames listed in a roster of the enrollment form.
+
+    Validators of the last processed response are kept in the cache and sent
+    with the next request. A `304 Not Modified` answer yields `None` so that
+    callers can skip processing. With `ijson` available the `result` array is
+    parsed incrementally from the response stream.
+    """
+
+    def __init__(self, url, alias=None):
+        self.url = url
+        self._alias = alias
+        self.validators = dict()
+
+    @property
+    def cache(self):
+        return get_cache(self._alias or settings.MFA_ROSTER_CACHE)
+
+    @property
+    def key(self):
+        return f"mfa:roster:{hashlib.sha1(self.url.encode('utf-8')).hexdigest()}"
+
+    def _records(self, response):
+        if ijson:
+            response.raw.decode_content = True
+            return ijson.items(response.raw, "result.item")
+        return iter(response.json().get("result", []))
+
+    def fetch(self):
+        """
+        Return the list of usernames or `None` if the roster did not change.
+        """
+        headers = dict()
+        cache = self.cache
+        cached = cache.get(self.key) if cache else None
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        with session().get(
+            self.url,
+            headers=headers,
+            stream=True,
+            timeout=settings.MFA_ROSTER_TIMEOUT,
+        ) as response:
+            if response.status_code == 304:
+                logger.debug(f"Roster {self.url} has not been modified")
+                return None
+            response.raise_for_status()
+            self.validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            return [
+                r.get("benutzername")
+                for r in self._records(response)
+                if r.get("benutzername")
+            ]
+
+    def commit(self):
+        """
+        Remember the validators of the last fetched roster.
+
+        Call this only after the roster has been processed so that a failed
+        run does not cause the next one to be skipped.
+        """
+        cache = self.cache
+        if cache and any(self.validators.values()):
+            cache.set(self.key, self.validators, settings.MFA_ROSTER_CACHE_TIMEOUT)
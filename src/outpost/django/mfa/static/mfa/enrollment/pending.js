@@ -0,0 +1,46 @@
+(() => {
+
+  const interval = 2000;
+
+  let pending = null;
+  let deadline = null;
+
+  function fail() {
+    document.getElementById("progress").classList.add("d-none");
+    document.getElementById("error").classList.remove("d-none");
+  }
+
+  function retry() {
+    if (Date.now() > deadline) {
+      fail();
+    } else {
+      window.setTimeout(poll, interval);
+    }
+  }
+
+  function poll() {
+    fetch(pending.dataset.status, { credentials: "same-origin" })
+      .then((response) => response.json())
+      .then((data) => {
+        if (data.status === "unlocked") {
+          window.location.href = data.url || pending.dataset.url;
+        } else if (data.status === "failed") {
+          fail();
+        } else {
+          retry();
+        }
+      })
+      .catch((err) => {
+        console.error(`An error occurred: ${err}`);
+        retry();
+      });
+  }
+
+  function startup() {
+    pending = document.getElementById("pending");
+    deadline = Date.now() + pending.dataset.timeout * 1000;
+    poll();
+  }
+
+  window.addEventListener("load", startup, false);
+})();
@@ -5,335 +5,914 @@ from datetime import (
     timedelta,
 )
 
-import duo_client
 import isodate
 import requests
-from celery import shared_task
+from celery import (
+    chord,
+    shared_task,
+)
 from django.contrib.auth import get_user_model
-from django.core.cache import caches
-from django.core.cache.backends.base import InvalidCacheBackendError
 from django.db import transaction
+from django.db.models import (
+    Exists,
+    Max,
+    OuterRef,
+    Q,
+)
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext_lazy as _
-from django_auth_ldap.backend import LDAPBackend
 from ldap3 import (
-    ALL,
-    SAFE_SYNC,
-    Connection,
-    ObjectDef,
-    Reader,
-    Server,
-)
-from tenacity import (
-    RetryError,
-    Retrying,
-    stop_after_attempt,
-    wait_exponential,
+    MODIFY_ADD,
+    MODIFY_DELETE,
 )
+from ldap3.core.exceptions import LDAPException
 
 from .conf import settings
+from .directory import (
+    MembershipIndex,
+    find_users,
+    highest_usn,
+    modify_members,
+    paged_search,
+    pool,
+    shard_filters,
+)
+from .duo import (
+    ActivationPool,
+    DuoUser,
+    PhoneCleanup,
+    client,
+    snapshot,
+    user_index,
+)
+from .metrics import metrics
+from .roster import Roster
+from .utils import (
+    Progress,
+    chunked,
+    get_cache,
+    merge_results,
+)
 
 logger = logging.getLogger(__name__)
 
 
-class UserTasks:
-    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:synchronize")
-    def synchronize(task, base, dry_run=False):
-        from .models import LockedUser
+def lock_users(ldap, users, dry_run=False):
+    """
+    Add the accounts of `LockedUser` objects to the locked LDAP group.
+
+    Accounts are resolved with batched searches, membership is taken from
+    their `memberOf` attribute and all additions are sent as batched modify
+    operations. Returns the objects whose lock state has to be saved.
+    """
+    group = settings.MFA_LDAP_GROUP_USERS_LOCKED
+    entries = find_users(
+        ldap,
+        settings.MFA_LDAP_BASE,
+        [u.local.username for u in users],
+        ("memberOf",),
+    )
+    now = timezone.now()
+    changed = list()
+    pending = dict()
+    for user in users:
+        entry = entries.get(user.local.username.lower())
+        if not entry:
+            logger.error(f"Could not find {user.local.username} through LDAP")
+            continue
+        if entry.member_of(group):
+            logger.debug(f"User {user.local.username} is already locked out from DUO")
+            user.unlocked = None
+            if not user.locked:
+                user.locked = now
+            changed.append(user)
+        else:
+            pending[entry.dn] = user
+    if dry_run:
+        return changed
+    for dn in modify_members(ldap, group, MODIFY_ADD, list(pending)):
+        user = pending.pop(dn)
+        user.locked = now
+        user.unlocked = None
+        changed.append(user)
+    for user in pending.values():
+        logger.error(f"Could not add {user.local.username} to MFA locked group")
+    return changed
 
-        logger.info("Synchronizing users to DUO")
 
-        if task.request.delivery_info:
-            queue = task.request.delivery_info.get("routing_key")
+def unlock_users(ldap, users, dry_run=False):
+    """
+    Remove the accounts of `LockedUser` objects from the locked LDAP group.
+
+    Objects without a directory account are deleted. Returns the objects
+    whose lock state has to be saved.
+    """
+    from .models import LockedUser
+
+    group = settings.MFA_LDAP_GROUP_USERS_LOCKED
+    entries = find_users(
+        ldap,
+        settings.MFA_LDAP_BASE,
+        [u.local.username for u in users],
+        ("memberOf",),
+    )
+    now = timezone.now()
+    changed = list()
+    pending = dict()
+    missing = list()
+    for user in users:
+        entry = entries.get(user.local.username.lower())
+        if not entry:
+            logger.error(f"Could not find {user.local.username} through LDAP")
+            missing.append(user.pk)
+            continue
+        if not entry.member_of(group):
+            logger.warning(
+                f"User {user.local.username} is no member of locked group in LDAP"
+            )
+            user.locked = None
+            if not user.unlocked:
+                user.unlocked = now
+            changed.append(user)
         else:
-            queue = None
+            pending[entry.dn] = user
+    LockedUser.objects.filter(pk__in=missing).delete()
+    if dry_run:
+        return changed
+    for dn in modify_members(ldap, group, MODIFY_DELETE, list(pending)):
+        user = pending.pop(dn)
+        user.locked = None
+        user.unlocked = now
+        changed.append(user)
+    for user in pending.values():
+        logger.error(f"Could not remove {user.local.username} from mfa_group_locked")
+    return changed
+
+
+def store_mark(base, server, usn, full=None):
+    """
+    Remember the USN up to which entries below `base` were synchronized.
+    """
+    from .models import SynchronizationMark
 
-        api = duo_client.Admin(
-            ikey=settings.MFA_DUO_IKEY,
-            skey=settings.MFA_DUO_SKEY,
-            host=settings.MFA_DUO_API_HOST,
+    defaults = {"server": server, "usn": usn}
+    if full:
+        defaults["full"] = parse_datetime(full)
+    SynchronizationMark.objects.update_or_create(base=base, defaults=defaults)
+
+
+def create_users(entries):
+    """
+    Create local users from directory entries keyed by username.
+
+    Fields are filled according to `AUTH_LDAP_USER_ATTR_MAP` and passwords
+    are unusable, as for users created by django-auth-ldap. Its signals and
+    group mirroring are skipped, they take effect on the first login. Users
+    created concurrently are kept. Returns the users keyed by username.
+    """
+    User = get_user_model()
+    attributes = getattr(settings, "AUTH_LDAP_USER_ATTR_MAP", {})
+    users = list()
+    for username, entry in entries.items():
+        user = User(username=username)
+        for field, attribute in attributes.items():
+            value = entry.value(attribute)
+            if value is not None:
+                setattr(user, field, value)
+        user.set_unusable_password()
+        users.append(user)
+    User.objects.bulk_create(users, 1000, ignore_conflicts=True)
+    created = dict()
+    for chunk in chunked(list(entries), 1000):
+        created.update(
+            User.objects.filter(username__in=chunk).in_bulk(field_name="username")
         )
+    return created
+
+
+def refresh_duo_state(api, now=None):
+    """
+    Mirror the enrollment state of all DUO users into `DuoUserState`.
+
+    Only new and changed rows are written, unchanged rows just get their
+    `seen` timestamp updated and rows of users no longer present in DUO are
+    removed. The DUO snapshot is replaced with the fetched users as well.
+    """
+    from .models import DuoUserState
+
+    now = now or timezone.now()
+    users = user_index(api)
+    snapshot.store(users)
 
-        ldap = Connection(
-            Server(settings.MFA_LDAP_HOST, get_info=ALL),
-            settings.MFA_LDAP_BIND_DN,
-            settings.MFA_LDAP_PASSWORD,
-            auto_bind=True,
-            auto_range=True,
-            client_strategy=SAFE_SYNC,
+    existing = {
+        username: (pk, user_id, enrolled, created)
+        for pk, username, user_id, enrolled, created in DuoUserState.objects.values_list(
+            "pk", "username", "user_id", "enrolled", "created"
         )
+    }
+    created = list()
+    changed = list()
+    unchanged = list()
+    for user in users.values():
+        state = DuoUserState(
+            username=user.username,
+            user_id=user.user_id,
+            enrolled=user.is_enrolled,
+            created=(
+                datetime.fromtimestamp(user.created, tz=timezone.utc)
+                if user.created
+                else None
+            ),
+            seen=now,
+        )
+        current = existing.pop(user.username, None)
+        if not current:
+            created.append(state)
+        elif current[1:] != (state.user_id, state.enrolled, state.created):
+            state.pk = current[0]
+            changed.append(state)
+        else:
+            unchanged.append(current[0])
+
+    # Runs of enrollment_timeout for different bases may refresh at the
+    # same time, rows created by another one are left as they are.
+    DuoUserState.objects.bulk_create(created, 1000, ignore_conflicts=True)
+    DuoUserState.objects.bulk_update(
+        changed, ("user_id", "enrolled", "created", "seen"), 1000
+    )
+    for chunk in chunked(unchanged, 1000):
+        DuoUserState.objects.filter(pk__in=chunk).update(seen=now)
+    for chunk in chunked([current[0] for current in existing.values()], 1000):
+        DuoUserState.objects.filter(pk__in=chunk).delete()
+    return {
+        "created": len(created),
+        "updated": len(changed),
+        "deleted": len(existing),
+    }
+
+
+def outbox_key(operation, username):
+    """
+    Idempotency key of an operation, shared by lock and unlock of a user so
+    that the last of both is the one considered pending.
+    """
+    from .models import PendingOperation
+
+    kind = "activate" if operation == PendingOperation.ACTIVATE else "lock"
+    return f"mfa:outbox:{kind}:{username}"
 
-        duo_users = {u["username"]: u for u in api.get_users()}
 
-        mfa_group = (
-            Reader(ldap, ObjectDef("group", ldap), settings.MFA_LDAP_GROUP_USERS)
-            .search_object()
-            .entry_writable()
+def enqueue(operations, queue=None):
+    """
+    Record `(operation, username)` pairs in the outbox.
+
+    The rows are part of the current transaction, so they only become
+    visible together with the changes that caused them. A single `flush` is
+    sent to `queue` once the transaction commits, without a queue the outbox
+    is flushed in the current process after the commit.
+
+    A lock or unlock replaces any lock or unlock still pending for the user,
+    also one waiting for a retry, so an older operation can never undo a
+    newer one. An operation that equals the one already pending for the user
+    according to its idempotency key is skipped, as long as the outbox still
+    holds a row for it. Keys are only a hint since they can outlive their
+    rows, e.g. when a worker dies before the commit hook runs. They are
+    written after the commit and expire after `MFA_OUTBOX_TIMEOUT` in case
+    the flush never removes them. Returns the number of recorded operations.
+    """
+    from .models import PendingOperation
+
+    cache = get_cache(settings.MFA_OUTBOX_CACHE)
+    operations = list(operations)
+    keys = [outbox_key(o, u) for o, u in operations]
+    current = cache.get_many(set(keys)) if cache else dict()
+    hinted = {k: (o, u) for (o, u), k in zip(operations, keys) if current.get(k) == o}
+    pending = set()
+    for chunk in chunked(sorted(set(hinted.values())), 1000):
+        pending.update(
+            PendingOperation.objects.filter(
+                username__in={u for o, u in chunk},
+                operation__in={o for o, u in chunk},
+            ).values_list("operation", "username")
         )
-        reader = Reader(
-            ldap,
-            ObjectDef("person", ldap),
-            base,
-            attributes=("cn", "distinguishedName"),
+    current = {k: o for k, (o, u) in hinted.items() if (o, u) in pending}
+    rows = list()
+    recorded = dict()
+    for (operation, username), key in zip(operations, keys):
+        if current.get(key) == operation:
+            logger.debug(f"Operation {operation} for {username} is already pending")
+            continue
+        current[key] = recorded[key] = operation
+        rows.append(PendingOperation(operation=operation, username=username))
+    if not rows:
+        return 0
+    superseding = [r.username for r in rows if r.operation != PendingOperation.ACTIVATE]
+    with transaction.atomic():
+        for chunk in chunked(superseding, 1000):
+            PendingOperation.objects.filter(
+                username__in=chunk,
+                operation__in=(PendingOperation.LOCK, PendingOperation.UNLOCK),
+            ).delete()
+        PendingOperation.objects.bulk_create(rows, 1000)
+    if cache:
+        transaction.on_commit(
+            lambda: cache.set_many(recorded, settings.MFA_OUTBOX_TIMEOUT)
         )
+    if queue:
+        transaction.on_commit(lambda: UserTasks().flush.apply_async(queue=queue))
+    else:
+        transaction.on_commit(lambda: UserTasks().flush())
+    return len(rows)
+
+
+def carry_out(rows):
+    """
+    Carry out claimed outbox rows and tell the finished from the failed.
+
+    Only the last lock or unlock of a user is carried out, the rows it
+    supersedes count as finished, also when a newer row was recorded after
+    the batch had been claimed. Activations are done once per user and only
+    after the user shows up in the MFA group, which may take a while to
+    replicate. Returns lists of finished and failed rows and counts of
+    the operations carried out.
+    """
+    from .models import (
+        LockedUser,
+        PendingOperation,
+    )
 
-        retry = Retrying(
-            stop=stop_after_attempt(10),
-            wait=wait_exponential(multiplier=1, min=4, max=10),
+    latest = dict()
+    activations = dict()
+    done = list()
+    for row in rows:
+        if row.operation == PendingOperation.ACTIVATE:
+            target = activations
+        else:
+            target = latest
+        if row.username in target:
+            done.append(target[row.username])
+        target[row.username] = row
+    newest = dict()
+    for chunk in chunked(list(latest), 1000):
+        newest.update(
+            PendingOperation.objects.filter(
+                username__in=chunk,
+                operation__in=(PendingOperation.LOCK, PendingOperation.UNLOCK),
+            )
+            .values_list("username")
+            .annotate(newest=Max("pk"))
         )
+    for username, row in list(latest.items()):
+        if newest.get(username, row.pk) > row.pk:
+            logger.debug(f"Skipping superseded {row.operation} of {username}")
+            done.append(latest.pop(username))
+    counts = dict(coalesced=len(done), locked=0, unlocked=0, activated=0)
+    failed = list()
 
-        for c, u in enumerate(reader.search()):
-            if queue:
-                task.update_state(state="PROGRESS", meta={"progress": c})
-            duo = duo_users.get(u.cn.value)
-            if duo:
-                logger.debug(f"User {u.cn.value} is already enabled for DUO")
-                if duo.get("is_enrolled"):
-                    try:
-                        locked = LockedUser.objects.get(local__username=u.cn.value)
-                    except LockedUser.DoesNotExist:
-                        pass
-                    else:
-                        locked.delete()
-                continue
-            if u.distinguishedName.value not in mfa_group.member.values:
-                mfa_group.member += u.distinguishedName.value
-                if not dry_run:
-                    if not mfa_group.entry_commit_changes():
-                        logger.error(f"Could not add {u.cn.value} to mfa_group")
-                        continue
-                    if queue:
-                        UserTasks().activate.apply_async((u.cn.value,), queue=queue)
-                        continue
-                    try:
-                        for attempt in retry.copy():
-                            with attempt:
-                                logger.info(f"Activating user {u.cn.value} for DUO")
-                                api.sync_user(
-                                    u.cn.value, settings.MFA_DUO_DIRECTORY_KEY
-                                )
-                    except RetryError:
-                        logger.error(f"Could not activate {u.cn.value} for DUO")
+    actions = (
+        (PendingOperation.LOCK, lock_users, "locked"),
+        (PendingOperation.UNLOCK, unlock_users, "unlocked"),
+    )
+    for action, func, key in actions:
+        pending = {u: r for u, r in latest.items() if r.operation == action}
+        if not pending:
+            continue
+        users = list(
+            LockedUser.objects.filter(local__username__in=list(pending)).select_related(
+                "local"
+            )
+        )
+        try:
+            with pool.connection() as ldap:
+                changed = func(ldap, users)
+        except LDAPException as e:
+            logger.error(f"Could not {action} {len(pending)} users: {e}")
+            failed.extend(pending.values())
+            continue
+        LockedUser.objects.bulk_update(changed, ("locked", "unlocked"), 1000)
+        counts[key] += len(changed)
+        # Users whose lock is gone, e.g. because they left the directory, need
+        # nothing more.
+        succeeded = {u.pk for u in changed}
+        remaining = set(
+            LockedUser.objects.filter(
+                pk__in=[u.pk for u in users if u.pk not in succeeded]
+            ).values_list("local__username", flat=True)
+        )
+        for username, row in pending.items():
+            (failed if username in remaining else done).append(row)
+
+    if activations:
+        try:
+            with pool.connection() as ldap:
+                entries = find_users(
+                    ldap, settings.MFA_LDAP_BASE, list(activations), ("memberOf",)
+                )
+        except LDAPException as e:
+            logger.error(f"Could not look up {len(activations)} users: {e}")
+            entries = dict()
+        ready = list()
+        for username, row in activations.items():
+            entry = entries.get(username.lower())
+            if entry and entry.member_of(settings.MFA_LDAP_GROUP_USERS):
+                ready.append(username)
+            else:
+                logger.warning(f"User {username} not present in MFA LDAP group")
+                failed.append(row)
+        with ActivationPool(client()) as activation:
+            for username in ready:
+                activation.submit(username)
+        snapshot.patch(activation.activated)
+        counts["activated"] += len(activation.activated)
+        for username in ready:
+            row = activations[username]
+            (failed if username in activation.failed else done).append(row)
+    return done, failed, counts
+
+
+class UserTasks:
+    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:synchronize")
+    def synchronize(
+        task,
+        base,
+        dry_run=False,
+        batch_size=None,
+        full=False,
+        shards=None,
+        shard=None,
+        since=None,
+        server=None,
+        parent=None,
+    ):
+        """
+        Add persons below `base` that are not known to DUO to the MFA group.
+
+        With more than one shard the task acts as coordinator: it takes care
+        of the steps that concern the whole directory, warms the DUO snapshot
+        and replaces itself with a chord of shard tasks, each restricted to
+        the `shard` filter, whose results are merged under its own task id.
+
+        USNs are local to a domain controller, so a shard only searches for
+        entries changed `since` a USN if it is connected to `server`, the
+        controller the USN was read from, and scans its whole slice otherwise.
+        """
+        from .models import (
+            LockedUser,
+            PendingOperation,
+            SynchronizationMark,
+        )
+
+        if shard is None:
+            logger.info("Synchronizing users to DUO")
+        else:
+            logger.info(f"Synchronizing users in shard {shard} to DUO")
+
+        phases = metrics.phases("synchronize")
+
+        batch_size = batch_size or settings.MFA_LDAP_MODIFY_BATCH_SIZE
+
+        if task.request.delivery_info:
+            queue = task.request.delivery_info.get("routing_key")
+        else:
+            queue = None
+
+        api = client()
+
+        duo_users = snapshot.get(api)
+        phases.lap("duo_users")
+
+        mark = None
+        if shard is None:
+            enrolled = [
+                pk
+                for pk, username in LockedUser.objects.values_list(
+                    "pk", "local__username"
+                )
+                if username in duo_users and duo_users[username].is_enrolled
+            ]
+            for chunk in chunked(enrolled, 1000):
+                LockedUser.objects.filter(pk__in=chunk).delete()
+            now = timezone.now()
+            previous = SynchronizationMark.objects.filter(base=base).first()
+            phases.lap("database")
+
+            def resume(ldap):
+                server, usn = highest_usn(ldap)
+                if (
+                    not full
+                    and previous
+                    and usn
+                    and previous.server == server
+                    and previous.usn <= usn
+                    and now - previous.full
+                    < isodate.parse_duration(settings.MFA_LDAP_FULL_SCAN_INTERVAL)
+                ):
+                    logger.info(
+                        f"Synchronizing entries changed since USN {previous.usn}"
+                    )
+                    since = previous.usn + 1
+                else:
+                    logger.info(f"Synchronizing all entries in {base}")
+                    since = None
+                if usn and not dry_run:
+                    mark = {
+                        "base": base,
+                        "server": server,
+                        "usn": usn,
+                        "full": None if since else now.isoformat(),
+                    }
+                else:
+                    mark = None
+                return server, since, mark
+
+            shards = shards or settings.MFA_TASK_SHARDS
+            if shards > 1 and queue:
+                with pool.connection() as ldap:
+                    server, since, mark = resume(ldap)
+                logger.info(f"Dispatching {shards} synchronization shards")
+                return task.replace(
+                    chord(
+                        [
+                            UserTasks().synchronize.signature(
+                                (base, dry_run, batch_size),
+                                {
+                                    "shard": f,
+                                    "since": since,
+                                    "server": server,
+                                    "parent": task.request.id,
+                                },
+                                queue=queue,
+                            )
+                            for f in shard_filters(shards)
+                        ],
+                        UserTasks().merge.signature((mark,), queue=queue),
+                    )
+                )
+
+        with ActivationPool(api) as activation, pool.connection() as ldap:
+            if shard is None:
+                server, since, mark = resume(ldap)
+            elif since and highest_usn(ldap)[0] != server:
+                logger.warning(
+                    f"Scanning all entries in shard {shard}, "
+                    f"USN {since} was not read from this server"
+                )
+                since = None
+            query = f"(uSNChanged>={since})" if since else ""
+            members = MembershipIndex.from_group(ldap, settings.MFA_LDAP_GROUP_USERS)
+            entries = paged_search(
+                ldap, base, f"(&(objectClass=person){query}{shard or ''})", ("cn",)
+            )
+
+            pending = dict()
+            progress = Progress(task, parent=parent)
+
+            def commit():
+                added = modify_members(
+                    ldap,
+                    settings.MFA_LDAP_GROUP_USERS,
+                    MODIFY_ADD,
+                    list(pending),
+                    batch_size,
+                )
+                progress.count("added", len(added))
+                progress.count("errors", len(pending) - len(added))
+                for dn in added:
+                    members.add(dn)
+                    if not queue:
+                        activation.submit(pending[dn])
+                if queue:
+                    enqueue(
+                        ((PendingOperation.ACTIVATE, pending[dn]) for dn in added),
+                        queue,
+                    )
+                pending.clear()
+
+            for u in entries:
+                username = u.value("cn")
+                progress.step()
+                if username in duo_users:
+                    logger.debug(f"User {username} is already enabled for DUO")
+                    continue
+                if u.dn in members:
+                    continue
+                if dry_run:
+                    members.add(u.dn)
+                    continue
+                pending[u.dn] = username
+                if len(pending) >= batch_size:
+                    commit()
+            if pending:
+                commit()
+            phases.lap("directory")
+
+        phases.lap("activation")
+        snapshot.patch(activation.activated)
+        progress.count("errors", len(activation.failed))
+        progress.report()
+        if activation.failed:
+            logger.error(
+                f"Could not activate {len(activation.failed)} users for DUO: "
+                f"{', '.join(sorted(activation.failed))}"
+            )
+
+        # Entries that could not be added are only found again by a search
+        # from the previous mark, so it is kept until a run succeeds.
+        if mark and progress.counters.get("errors"):
+            logger.warning("Keeping synchronization mark because of errors")
+        elif mark:
+            store_mark(**mark)
+            phases.lap("database")
+
+        return dict(progress.meta, seconds=phases.done(), **activation.summary)
 
     @shared_task(
         bind=True, ignore_result=False, name=f"{__name__}.User:enrollment_timeout"
     )
     def enrollment_timeout(task, base, interval, dry_run=False):
-        from .models import LockedUser
+        """
+        Lock persons below `base` that did not enroll in DUO within `interval`.
+
+        Candidates are taken from the `DuoUserState` mirror, which is
+        refreshed first if it is older than `MFA_DUO_STATE_MAX_AGE`, and only
+        those are looked up in the directory.
+        """
+        from .models import (
+            DuoUserState,
+            LockedUser,
+            PendingOperation,
+        )
 
         User = get_user_model()
 
         logger.info("Locking users with expired DUO enrollment")
 
+        phases = metrics.phases("enrollment_timeout")
+
         if task.request.delivery_info:
             queue = task.request.delivery_info.get("routing_key")
         else:
             queue = None
 
-        api = duo_client.Admin(
-            ikey=settings.MFA_DUO_IKEY,
-            skey=settings.MFA_DUO_SKEY,
-            host=settings.MFA_DUO_API_HOST,
-        )
-
-        ldap = Connection(
-            Server(settings.MFA_LDAP_HOST, get_info=ALL),
-            settings.MFA_LDAP_BIND_DN,
-            settings.MFA_LDAP_PASSWORD,
-            auto_bind=True,
-            auto_range=True,
-            client_strategy=SAFE_SYNC,
-        )
+        now = timezone.now()
+        delta = isodate.parse_duration(interval)
 
-        duo_users = {u["username"]: u for u in api.get_users()}
+        seen = DuoUserState.objects.aggregate(seen=Max("seen"))["seen"]
+        if not seen or now - seen > timedelta(seconds=settings.MFA_DUO_STATE_MAX_AGE):
+            logger.info("Refreshing outdated DUO user state")
+            refresh_duo_state(client(), now)
+        phases.lap("duo_users")
 
-        mfa_locked_group = (
-            Reader(ldap, ObjectDef("group", ldap), settings.MFA_LDAP_GROUP_USERS_LOCKED)
-            .search_object()
-            .entry_writable()
+        # Unenrolled users past their enrollment window which are neither
+        # locked already nor within the window of a manual unlock.
+        settled = LockedUser.objects.filter(
+            Q(locked__isnull=False) | Q(unlocked__gt=now - delta),
+            local__username=OuterRef("username"),
         )
-        reader = Reader(
-            ldap,
-            ObjectDef("person", ldap),
-            base,
-            attributes=("cn", "distinguishedName"),
+        candidates = list(
+            DuoUserState.objects.filter(enrolled=False, created__lt=now - delta)
+            .filter(~Exists(settled))
+            .values_list("username", flat=True)
         )
-
-        now = timezone.now()
-
-        delta = isodate.parse_duration(interval)
-
-        for c, u in enumerate(reader.search()):
-            if task.request.delivery_info:
-                task.update_state(state="PROGRESS", meta={"progress": c})
-            duo = duo_users.get(u.cn.value)
-            if not duo:
-                logger.debug(f"User {u.cn.value} ist not activated for DUO")
-                continue
-            if duo.get("is_enrolled"):
-                logger.debug(f"User {u.cn.value} is already enrolled in DUO")
-                continue
-            diff = now - timezone.make_aware(
-                datetime.fromtimestamp(duo.get("created")), timezone=timezone.utc
+        locks = dict()
+        for chunk in chunked(candidates, 1000):
+            locks.update(
+                (l.local.username, l)
+                for l in LockedUser.objects.filter(local__username__in=chunk)
+                .select_related("local")
+                .only("locked", "unlocked", "local__username")
             )
-            if diff < delta:
-                logger.debug(
-                    f"User {u.cn.value} is within enrollment window {diff} for DUO"
-                )
-                continue
+        updates = list()
+        expired = list()
+        phases.lap("database")
 
-            try:
-                user = LockedUser.objects.get(local__username=u.cn.value)
-            except LockedUser.DoesNotExist:
-                logger.debug(
-                    f"User {u.cn.value} is locked but no local objects has been found"
-                )
-            else:
-                logger.debug(f"User {u.cn.value} has local lock object")
-                if u.distinguishedName.value in mfa_locked_group.member.values:
-                    logger.debug(
-                        f"User {u.cn.value} is already locked from enrollment window {diff} for DUO"
-                    )
-                    if not user.locked:
-                        user.locked = timezone.now()
-                        user.unlocked = None
-                        user.save()
-                    continue
-                if user.unlocked:
-                    if now - user.unlocked < delta:
+        # Attributes for local users are read along, so that missing ones
+        # can be created without another search.
+        attributes = ("memberOf",) + tuple(
+            getattr(settings, "AUTH_LDAP_USER_ATTR_MAP", {}).values()
+        )
+        found = dict()
+        progress = Progress(task, total=len(candidates))
+        with pool.connection() as ldap:
+            for chunk in chunked(candidates, settings.MFA_LDAP_FILTER_CHUNK_SIZE):
+                entries = find_users(ldap, base, chunk, attributes)
+                for username in chunk:
+                    progress.step()
+                    entry = entries.get(username.lower())
+                    if not entry:
+                        logger.debug(f"User {username} is not below {base}")
+                        continue
+                    user = locks.get(username)
+                    if user and entry.member_of(settings.MFA_LDAP_GROUP_USERS_LOCKED):
                         logger.debug(
-                            f"User {u.cn.value} has local unlock and is within enrollment window"
+                            f"User {username} is already locked from enrollment window for DUO"
                         )
+                        user.locked = now
+                        user.unlocked = None
+                        updates.append(user)
                         continue
+                    if dry_run:
+                        continue
+                    expired.append(username)
+                    found[username] = entry
+        phases.lap("directory")
 
-            if dry_run:
-                continue
-            try:
-                local = User.objects.get(username=u.cn.value)
-            except User.DoesNotExist:
-                local = LDAPBackend().populate_user(u.cn.value)
-                if local is None:
-                    logger.error(
-                        f"Could not populate local user {u.cn.value} from LDAP"
-                    )
-                    continue
-            user, created = LockedUser.objects.get_or_create(local=local)
-            if created or not user.locked:
-                if queue:
-                    transaction.on_commit(
-                        lambda: UserTasks().lock.apply_async((user.pk,), queue=queue)
-                    )
-                else:
-                    UserTasks().lock(user.pk)
+        LockedUser.objects.bulk_update(updates, ("locked", "unlocked"), 1000)
 
-    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:lock")
-    def lock(task, pk, dry_run=False):
-        from .models import LockedUser
+        if not expired:
+            phases.lap("database")
+            progress.report()
+            return dict(progress.meta, seconds=phases.done())
 
-        user = LockedUser.objects.get(pk=pk)
+        unlocked = [u for u in expired if u not in locks]
+        users = dict()
+        for chunk in chunked(unlocked, 1000):
+            users.update(
+                User.objects.filter(username__in=chunk).in_bulk(field_name="username")
+            )
+        missing = {u: found[u] for u in unlocked if u not in users}
+        if missing:
+            logger.info(f"Creating {len(missing)} local users from LDAP")
+            users.update(create_users(missing))
 
-        logger.info(f"Locking user {user} with expired DUO enrollment")
+        pending = [locks[u] for u in expired if u in locks and not locks[u].locked]
+        created = list()
+        for username in unlocked:
+            local = users.get(username)
+            if not local:
+                logger.error(f"Could not create local user {username} from LDAP")
+                progress.count("errors")
+                continue
+            created.append(LockedUser(local=local))
+        # The locks and the operations carrying them out into the directory
+        # are committed together.
+        with transaction.atomic():
+            pending.extend(LockedUser.objects.bulk_create(created, 1000))
+            enqueue(((PendingOperation.LOCK, u.local.username) for u in pending), queue)
+        phases.lap("database")
 
-        ldap = Connection(
-            Server(settings.MFA_LDAP_HOST, get_info=ALL),
-            settings.MFA_LDAP_BIND_DN,
-            settings.MFA_LDAP_PASSWORD,
-            auto_bind=True,
-            auto_range=True,
-            client_strategy=SAFE_SYNC,
-        )
+        progress.count("locked", len(pending))
+        progress.report()
+        return dict(progress.meta, seconds=phases.done())
 
-        mfa_locked_group = (
-            Reader(ldap, ObjectDef("group", ldap), settings.MFA_LDAP_GROUP_USERS_LOCKED)
-            .search_object()
-            .entry_writable()
+    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:refresh")
+    def refresh(task):
+        logger.info("Refreshing DUO user state")
+        with metrics.timer("task", task="refresh"):
+            summary = refresh_duo_state(client())
+        logger.info(
+            f"DUO user state: {summary['created']} created, "
+            f"{summary['updated']} updated, {summary['deleted']} deleted"
         )
+        return summary
+
+    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:merge")
+    def merge(task, results, mark=None):
+        """
+        Combine the results of the shards of a task.
 
-        reader = Reader(
-            ldap,
-            ObjectDef("person", ldap),
-            settings.MFA_LDAP_BASE,
-            f"(cn={user.local.username})",
-            attributes=("cn", "distinguishedName"),
+        Runs as chord callback in place of the coordinating task, so the
+        merged result is stored under the id of the coordinator.
+        """
+        results = [r for r in results if r]
+        merged = merge_results(results)
+        elapsed = max((r.get("elapsed") or 0 for r in results), default=0)
+        merged.update(
+            shards=len(results),
+            elapsed=elapsed,
+            throughput=(
+                round(merged.get("processed", 0) / elapsed, 1) if elapsed else None
+            ),
         )
+        Progress.clear(task.request.id, merged)
+        if mark and merged.get("errors"):
+            logger.warning("Keeping synchronization mark because of errors")
+        elif mark:
+            store_mark(**mark)
+        return merged
 
-        ad_user = next(iter(reader.search()), None)
+    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:flush")
+    def flush(task, batch_size=None):
+        """
+        Carry out the operations recorded in the outbox.
 
-        if ad_user.distinguishedName.value in mfa_locked_group.member.values:
-            logger.debug(f"User {ad_user.cn.value} is already locked out from DUO")
+        Due rows are claimed in batches by a short transaction. Concurrent
+        flushes skip them until the claim is older than
+        `MFA_OUTBOX_CLAIM_TIMEOUT`, which also hands rows of a crashed flush
+        to the next one. Directory and DUO calls run outside of transactions.
+        Failed operations stay in the outbox and become due again after
+        `3 ** attempts` seconds, after `MFA_OUTBOX_ATTEMPTS` attempts they
+        are dropped. Idempotency keys are released with the removed rows.
+        """
+        from .models import PendingOperation
 
-            user.unlocked = None
-            if not user.locked:
-                user.locked = timezone.now()
+        if task.request.delivery_info:
+            queue = task.request.delivery_info.get("routing_key")
         else:
-            mfa_locked_group.member += ad_user.distinguishedName.value
-            if not dry_run:
-                if mfa_locked_group.entry_commit_changes():
-                    user.locked = timezone.now()
-                    user.unlocked = None
-                else:
+            queue = None
+
+        phases = metrics.phases("flush")
+        batch_size = batch_size or settings.MFA_OUTBOX_BATCH_SIZE
+        timeout = timedelta(seconds=settings.MFA_OUTBOX_CLAIM_TIMEOUT)
+        cache = get_cache(settings.MFA_OUTBOX_CACHE)
+        summary = dict(
+            operations=0,
+            coalesced=0,
+            locked=0,
+            unlocked=0,
+            activated=0,
+            retried=0,
+            dropped=0,
+        )
+        retry = None
+        while True:
+            now = timezone.now()
+            with transaction.atomic():
+                batch = list(
+                    PendingOperation.objects.select_for_update(skip_locked=True)
+                    .filter(due__lte=now)
+                    .filter(Q(claimed__isnull=True) | Q(claimed__lt=now - timeout))
+                    .order_by("pk")
+                    .only("operation", "username", "attempts")[:batch_size]
+                )
+                PendingOperation.objects.filter(pk__in=[r.pk for r in batch]).update(
+                    claimed=now
+                )
+            phases.lap("database")
+            if not batch:
+                break
+
+            done, failed, counts = carry_out(batch)
+            summary["operations"] += len(batch)
+            for name, value in counts.items():
+                summary[name] += value
+            phases.lap("operations")
+
+            now = timezone.now()
+            retried = list()
+            for row in failed:
+                row.attempts += 1
+                if row.attempts >= settings.MFA_OUTBOX_ATTEMPTS:
                     logger.error(
-                        f"Could not add {ad_user.cn.value} to MFA locked group"
+                        f"Giving up on {row.operation} of {row.username} "
+                        f"after {row.attempts} attempts"
                     )
-        if not dry_run:
-            user.save()
+                    done.append(row)
+                    summary["dropped"] += 1
+                    continue
+                row.due = now + timedelta(seconds=3 ** row.attempts)
+                row.claimed = None
+                retried.append(row)
+                retry = min(retry or row.due, row.due)
+            summary["retried"] += len(retried)
+            with transaction.atomic():
+                PendingOperation.objects.filter(pk__in=[r.pk for r in done]).delete()
+                PendingOperation.objects.bulk_update(
+                    retried, ("attempts", "due", "claimed"), 1000
+                )
+                if cache:
+                    keys = {outbox_key(r.operation, r.username) for r in done}
+                    keys -= {outbox_key(r.operation, r.username) for r in retried}
+                    transaction.on_commit(lambda: cache.delete_many(keys))
+            phases.lap("database")
+            if len(batch) < batch_size:
+                break
 
-    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:unlock")
-    def unlock(task, pk, dry_run=False):
-        from .models import LockedUser
+        if retry and queue:
+            countdown = max((retry - timezone.now()).total_seconds(), 0)
+            UserTasks().flush.apply_async(countdown=countdown, queue=queue)
+        logger.info(
+            f"Flushed {summary['operations']} pending operations, "
+            f"{summary['coalesced']} coalesced, {summary['retried']} retried, "
+            f"{summary['dropped']} dropped"
+        )
+        return dict(summary, seconds=phases.done())
 
-        user = LockedUser.objects.get(pk=pk)
+    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:lock")
+    def lock(task, pk, dry_run=False):
+        from .models import LockedUser
 
-        logger.info(f"Unlocking user {user} for DUO enrollment")
+        user = LockedUser.objects.select_related("local").get(pk=pk)
 
-        ldap = Connection(
-            Server(settings.MFA_LDAP_HOST, get_info=ALL),
-            settings.MFA_LDAP_BIND_DN,
-            settings.MFA_LDAP_PASSWORD,
-            auto_bind=True,
-            auto_range=True,
-            client_strategy=SAFE_SYNC,
-        )
+        logger.info(f"Locking user {user} with expired DUO enrollment")
 
-        mfa_locked_group = (
-            Reader(ldap, ObjectDef("group", ldap), settings.MFA_LDAP_GROUP_USERS_LOCKED)
-            .search_object()
-            .entry_writable()
-        )
+        with pool.connection() as ldap:
+            changed = lock_users(ldap, [user], dry_run)
+        if changed and not dry_run:
+            user.save()
 
-        reader = Reader(
-            ldap,
-            ObjectDef("person", ldap),
-            settings.MFA_LDAP_BASE,
-            f"(cn={user.local.username})",
-            attributes=("cn", "distinguishedName"),
-        )
+    @shared_task(bind=True, ignore_result=False, name=f"{__name__}.User:unlock")
+    def unlock(task, pk, dry_run=False):
+        from .models import LockedUser
 
-        ad_user = next(iter(reader.search()), None)
+        user = LockedUser.objects.select_related("local").get(pk=pk)
 
-        if not ad_user:
-            logger.error(f"Could not find {user.local.username} through LDAP")
-            user.delete()
-            return
+        logger.info(f"Unlocking user {user} for DUO enrollment")
 
-        if ad_user.distinguishedName.value not in mfa_locked_group.member.values:
-            logger.warning(
-                f"User {ad_user.cn.value} is no member of locked group in LDAP"
-            )
-            user.locked = None
-            if not user.unlocked:
-                user.unlocked = timezone.now()
-        else:
-            mfa_locked_group.member -= ad_user.distinguishedName.value
-            if not dry_run:
-                if mfa_locked_group.entry_commit_changes():
-                    user.locked = None
-                    user.unlocked = timezone.now()
-                else:
-                    logger.error(
-                        f"Could not remove {ad_user.cn.value} from mfa_group_locked"
-                    )
-        if not dry_run:
+        with pool.connection() as ldap:
+            changed = unlock_users(ldap, [user], dry_run)
+        if changed and not dry_run:
             user.save()
 
     @shared_task(
@@ -341,23 +920,16 @@ class UserTasks:
         ignore_result=False,
         name=f"{__name__}.User:cleanup",
     )
-    def cleanup(task):
-        api = duo_client.Admin(
-            ikey=settings.MFA_DUO_IKEY,
-            skey=settings.MFA_DUO_SKEY,
-            host=settings.MFA_DUO_API_HOST,
+    def cleanup(task, dry_run=False, restart=False):
+        with metrics.timer("task", task="cleanup"):
+            summary = PhoneCleanup(client(), dry_run=dry_run).run(restart)
+        logger.info(
+            f"Phone cleanup {'(dry run) ' if dry_run else ''}"
+            f"checked {summary.get('users', 0)} users in {summary['seconds']}s: "
+            f"{summary.get('phones', 0)} unactivated phones, "
+            f"{summary.get('removed', 0)} removed, {summary.get('failed', 0)} failed"
         )
-
-        for u in api.get_users():
-            for p in u.get("phones", []):
-                if not p.get("number"):
-                    continue
-                if p.get("activated"):
-                    continue
-                user_id = u.get("user_id")
-                phone_id = p.get("phone_id")
-                logger.warning(f"Remove phone {phone_id} from user {user_id}")
-                api.delete_user_phone(user_id, phone_id)
+        return summary
 
     @shared_task(
         bind=True,
@@ -365,61 +937,63 @@ class UserTasks:
         name=f"{__name__}.User:form",
     )
     def form(task, url, base_dn):
-        from .models import LockedUser
+        from .models import (
+            LockedUser,
+            PendingOperation,
+        )
 
         if task.request.delivery_info:
             queue = task.request.delivery_info.get("routing_key")
         else:
             queue = None
 
-        today = date.today().strftime("%d.%m.%Y")
-
-        ldap = Connection(
-            Server(settings.MFA_LDAP_HOST, get_info=ALL),
-            settings.MFA_LDAP_BIND_DN,
-            settings.MFA_LDAP_PASSWORD,
-            auto_bind=True,
-            auto_range=True,
-            client_strategy=SAFE_SYNC,
-        )
-
-        mfa_group = (
-            Reader(ldap, ObjectDef("group", ldap), settings.MFA_LDAP_GROUP_USERS)
-            .search_object()
-            .entry_writable()
-        )
+        phases = metrics.phases("form")
 
-        person = ObjectDef("person", ldap)
+        today = date.today().strftime("%d.%m.%Y")
 
+        roster = Roster(url.format(today=today))
         try:
-            with requests.get(url.format(today=today)) as response:
-                usernames = [
-                    b.get("benutzername")
-                    for b in response.json().get("result", [])
-                    if b.get("benutzername")
-                ]
+            usernames = roster.fetch()
         except requests.HTTPError:
             if task.request.delivery_info:
-                task.retry(countdown=3 ** task.request.retries)
+                raise task.retry(countdown=3 ** task.request.retries)
+            raise
+        phases.lap("roster")
+        if usernames is None:
+            phases.done()
+            return
 
-        for username in usernames:
-            reader = Reader(ldap, person, base_dn, f"(cn={username})")
-            user = next(iter(reader.search() or []), None)
-            if not user:
-                continue
-            if user.distinguishedName.value not in mfa_group.member.values:
-                mfa_group.member += user.distinguishedName.value
-                if mfa_group.entry_commit_changes():
-                    logger.info(f"Added {username}")
-                    UserTasks().activate.apply_async((username,), queue=queue)
-                else:
-                    logger.info(f"Error {username}")
-            try:
-                locked = LockedUser.objects.get(local__username=username)
-            except LockedUser.DoesNotExist:
-                continue
-            else:
-                UserTasks().unlock.apply_async((locked.pk,), queue=queue)
+        group = settings.MFA_LDAP_GROUP_USERS
+
+        with pool.connection() as ldap:
+            entries = find_users(ldap, base_dn, usernames, ("memberOf",))
+            pending = {
+                e.dn: e.value("cn") for e in entries.values() if not e.member_of(group)
+            }
+            added = modify_members(ldap, group, MODIFY_ADD, list(pending))
+        phases.lap("directory")
+
+        operations = list()
+        for dn in added:
+            username = pending.pop(dn)
+            logger.info(f"Added {username}")
+            operations.append((PendingOperation.ACTIVATE, username))
+        for username in pending.values():
+            logger.info(f"Error {username}")
+
+        # Users unlocked by an earlier roster need no further unlock.
+        for chunk in chunked([u for u in usernames if u.lower() in entries], 1000):
+            operations.extend(
+                (PendingOperation.UNLOCK, username)
+                for username in LockedUser.objects.filter(local__username__in=chunk)
+                .exclude(unlocked__isnull=False)
+                .values_list("local__username", flat=True)
+            )
+        enqueue(operations, queue)
+        phases.lap("dispatch")
+
+        roster.commit()
+        phases.done()
 
     @shared_task(
         bind=True,
@@ -428,29 +1002,13 @@ class UserTasks:
         max_retries=10,
     )
     def activate(task, username):
-        api = duo_client.Admin(
-            ikey=settings.MFA_DUO_IKEY,
-            skey=settings.MFA_DUO_SKEY,
-            host=settings.MFA_DUO_API_HOST,
-        )
-        ldap = Connection(
-            Server(settings.MFA_LDAP_HOST, get_info=ALL),
-            settings.MFA_LDAP_BIND_DN,
-            settings.MFA_LDAP_PASSWORD,
-            auto_bind=True,
-            auto_range=True,
-            client_strategy=SAFE_SYNC,
-        )
-
-        ad_user = Reader(
-            ldap,
-            ObjectDef("person", ldap),
-            settings.MFA_LDAP_BASE,
-            f"(cn={username}",
-            attributes=("cn", "distinguishedName"),
-        ).search_object()
+        api = client()
+        with pool.connection() as ldap:
+            entry = find_users(
+                ldap, settings.MFA_LDAP_BASE, [username], ("memberOf",)
+            ).get(username.lower())
 
-        if settings.MFA_LDAP_GROUP_USERS not in ad_user.memberOf.values:
+        if not entry or not entry.member_of(settings.MFA_LDAP_GROUP_USERS):
             logger.error(f"User {username} not present in MFA LDAP group.")
             if task.request.delivery_info:
                 task.retry(countdown=3 ** task.request.retries)
@@ -459,8 +1017,10 @@ class UserTasks:
         logger.info(f"Activating user {username} for DUO")
 
         try:
-            api.sync_user(username, settings.MFA_DUO_DIRECTORY_KEY)
+            data = api.sync_user(username, settings.MFA_DUO_DIRECTORY_KEY)
         except RuntimeError:
             logger.error(f"Could not activate {username} for DUO")
             if task.request.delivery_info:
                 task.retry(countdown=3 ** task.request.retries)
+        else:
+            snapshot.patch((DuoUser.from_api(data),))
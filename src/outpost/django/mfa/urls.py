@@ -10,4 +10,14 @@ urlpatterns = [
         views.EnrollmentUnlockView.as_view(),
         name="enrollment-unlock",
     ),
+    path(
+        "enrollment/pending/",
+        views.EnrollmentPendingView.as_view(),
+        name="enrollment-pending",
+    ),
+    path(
+        "enrollment/status/",
+        views.EnrollmentStatusView.as_view(),
+        name="enrollment-status",
+    ),
 ]
@@ -0,0 +1,185 @@
+import functools
+import os
+import time
+from itertools import islice
+
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+from .conf import settings
+
+
+def get_cache(alias):
+    """
+    Return the Django cache `alias` or `None` if it is not configured.
+    """
+    try:
+        return caches[alias]
+    except InvalidCacheBackendError:
+        return None
+
+
+def per_process(factory):
+    """
+    Call `factory` once per process and return its result on later calls.
+
+    Objects holding sockets must not be shared with children forked by the
+    worker, so the object is created again once the process id changes.
+    """
+    instance = (None, None)
+
+    @functools.wraps(factory)
+    def get():
+        nonlocal instance
+        pid, current = instance
+        if pid != os.getpid():
+            current = factory()
+            instance = (os.getpid(), current)
+        return current
+
+    return get
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most `size` items.
+
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Progress:
+    """
+    Throttled `PROGRESS` state reporting for long running tasks.
+
+    Counters are updated for every item, but the result backend is only
+    written once `interval` seconds or `every` items have passed since the
+    last report. Reporting is disabled for tasks that are called directly.
+
+    Shards of a task pass the id of the coordinating task as `parent`. Their
+    counters are then added up in the cache and the totals are reported as
+    progress of the parent as well.
+    """
+
+    timeout = 86400
+
+    def __init__(self, task, total=None, interval=None, every=None, parent=None):
+        self.task = task
+        self.parent = parent
+        self.enabled = bool(task.request.id and task.request.delivery_info)
+        self.total = total
+        self.interval = interval or settings.MFA_PROGRESS_INTERVAL
+        self.every = every or settings.MFA_PROGRESS_EVERY
+        self.counters = {"processed": 0, "added": 0, "locked": 0, "errors": 0}
+        self.start = self.reported = time.monotonic()
+        self.last = 0
+        self.forwarded = dict()
+
+    @property
+    def meta(self):
+        elapsed = time.monotonic() - self.start
+        processed = self.counters["processed"]
+        return dict(
+            self.counters,
+            progress=processed,
+            total=self.total,
+            elapsed=round(elapsed, 3),
+            throughput=round(processed / elapsed, 1) if elapsed else None,
+        )
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def step(self, **counters):
+        self.counters["processed"] += 1
+        for name, value in counters.items():
+            self.count(name, value)
+        now = time.monotonic()
+        if (
+            now - self.reported >= self.interval
+            or self.counters["processed"] - self.last >= self.every
+        ):
+            self.report(now)
+
+    def report(self, now=None):
+        self.reported = now or time.monotonic()
+        self.last = self.counters["processed"]
+        if self.enabled:
+            self.task.update_state(state="PROGRESS", meta=self.meta)
+            if self.parent:
+                self.forward()
+
+    @staticmethod
+    def cache():
+        return get_cache(settings.MFA_PROGRESS_CACHE)
+
+    @classmethod
+    def keys(cls, parent, names):
+        return {name: f"mfa:progress:{parent}:{name}" for name in names}
+
+    def forward(self):
+        cache = self.cache()
+        if not cache:
+            return
+        keys = self.keys(self.parent, list(self.counters) + ["start"])
+        cache.add(keys["start"], time.time(), self.timeout)
+        for name, value in self.counters.items():
+            delta = value - self.forwarded.get(name, 0)
+            if delta:
+                cache.add(keys[name], 0, self.timeout)
+                cache.incr(keys[name], delta)
+        self.forwarded = dict(self.counters)
+        values = cache.get_many(keys.values())
+        meta = {name: values.get(keys[name], 0) for name in self.counters}
+        elapsed = time.time() - values.get(keys["start"], time.time())
+        meta.update(
+            progress=meta["processed"],
+            total=self.total,
+            elapsed=round(elapsed, 3),
+            throughput=round(meta["processed"] / elapsed, 1) if elapsed else None,
+        )
+        self.task.update_state(task_id=self.parent, state="PROGRESS", meta=meta)
+
+    @classmethod
+    def clear(cls, parent, names):
+        """
+        Remove the totals collected for the shards of `parent`.
+        """
+        cache = cls.cache()
+        if cache:
+            cache.delete_many(cls.keys(parent, list(names) + ["start"]).values())
+
+
+def merge_results(results):
+    """
+    Combine the result dictionaries of the shards of a task.
+
+    Numbers are added up, nested dictionaries are merged the same way and
+    any other value is taken from the last result that has it. Sums are
+    rounded to three decimals like the durations they usually are.
+
+    >>> merge_results([{"added": 1, "failed": {"a": "x"}}, {"added": 2, "failed": {}}])
+    {'added': 3, 'failed': {'a': 'x'}}
+    """
+    merged = dict()
+    for result in results:
+        for key, value in (result or {}).items():
+            current = merged.get(key)
+            if isinstance(value, dict):
+                merged[key] = merge_results((current or {}, value))
+            elif (
+                isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and isinstance(current, (int, float))
+            ):
+                merged[key] = round(current + value, 3)
+            else:
+                merged[key] = value if value is not None else current
+    return merged
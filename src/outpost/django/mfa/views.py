@@ -2,49 +2,62 @@ from urllib.request import urlopen
 
 from braces.views import LoginRequiredMixin
 from django.core.files.base import ContentFile
-from django.http import HttpResponseRedirect
-from django.views.generic import FormView
+from django.db import transaction
+from django.http import (
+    HttpResponseRedirect,
+    JsonResponse,
+)
+from django.urls import reverse_lazy
+from django.views.generic import (
+    FormView,
+    TemplateView,
+    View,
+)
 
 from . import (
     forms,
     models,
 )
 from .conf import settings
-from .tasks import UserTasks
+from .tasks import enqueue
 
 
 class EnrollmentUnlockView(LoginRequiredMixin, FormView):
     template_name = "mfa/enrollment/form.html"
     form_class = forms.EnrollmentUnlockForm
-    success_url = settings.MFA_ENROLLMENT_URL
+    success_url = reverse_lazy("mfa:enrollment-pending")
 
     def dispatch(self, request, *args, **kwargs):
         remote = request.META.get("REMOTE_ADDR")
         if not remote:
-            return HttpResponseRedirect(self.get_success_url())
+            return HttpResponseRedirect(settings.MFA_ENROLLMENT_URL)
         if not models.UnlockNetwork.objects.filter(
             inet__net_contains_or_equals=remote
         ).exists():
-            return HttpResponseRedirect(self.get_success_url())
+            return HttpResponseRedirect(settings.MFA_ENROLLMENT_URL)
         return super().dispatch(request, *args, **kwargs)
 
     def get(self, request, *args, **kwargs):
         try:
             models.LockedUser.objects.get(local=request.user)
         except models.LockedUser.DoesNotExist:
-            return HttpResponseRedirect(self.get_success_url())
+            return HttpResponseRedirect(settings.MFA_ENROLLMENT_URL)
         return super().get(request, *args, **kwargs)
 
     def form_valid(self, form):
         try:
             user = models.LockedUser.objects.get(local=self.request.user)
-            UserTasks().unlock(user.pk)
         except models.LockedUser.DoesNotExist:
-            return HttpResponseRedirect(self.get_success_url())
+            return HttpResponseRedirect(settings.MFA_ENROLLMENT_URL)
         with urlopen(form.cleaned_data.get("image")) as response:
             data = response.read()
         image = ContentFile(data, "cam.png")
-        models.UnlockEvent.objects.create(local=self.request.user, image=image)
+        with transaction.atomic():
+            models.UnlockEvent.objects.create(local=self.request.user, image=image)
+            enqueue(
+                ((models.PendingOperation.UNLOCK, user.username),),
+                queue="maintainance",
+            )
         return super().form_valid(form)
 
     def get_context_data(self, **kwargs):
@@ -54,3 +67,36 @@ class EnrollmentUnlockView(LoginRequiredMixin, FormView):
         kwargs["MFA_ENROLLMENT_WINDOW_DAYS"] = settings.MFA_ENROLLMENT_WINDOW_DAYS
         kwargs["MFA_ENROLLMENT_HELP_URL"] = settings.MFA_ENROLLMENT_HELP_URL
         return super().get_context_data(**kwargs)
+
+
+class EnrollmentPendingView(LoginRequiredMixin, TemplateView):
+    template_name = "mfa/enrollment/pending.html"
+
+    def get_context_data(self, **kwargs):
+        kwargs["MFA_ENROLLMENT_URL"] = settings.MFA_ENROLLMENT_URL
+        kwargs["MFA_ENROLLMENT_HELP_URL"] = settings.MFA_ENROLLMENT_HELP_URL
+        return super().get_context_data(**kwargs)
+
+
+class EnrollmentStatusView(LoginRequiredMixin, View):
+    """
+    Report whether the unlock of the current user is done, still pending or
+    failed, i.e. no unlock is left in the outbox while the user is locked.
+    """
+
+    def get(self, request, *args, **kwargs):
+        locked = models.LockedUser.objects.filter(
+            local=request.user, unlocked__isnull=True
+        ).exists()
+        if not locked:
+            status = "unlocked"
+        elif models.PendingOperation.objects.filter(
+            operation=models.PendingOperation.UNLOCK,
+            username=request.user.username,
+        ).exists():
+            status = "pending"
+        else:
+            status = "failed"
+        return JsonResponse(
+            {"status": status, "locked": locked, "url": settings.MFA_ENROLLMENT_URL}
+        )